@@ -0,0 +1,101 @@
+import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import typing
+
+log = logging.getLogger(__name__)
+
+
+class Archive:
+    """A local, replayable store of raw reporting API pages
+
+    Each page is saved as gzip-compressed NDJSON (one record per line) named
+    after the SHA-256 of its content, so a page that is fetched twice is only
+    stored once. Every saved page also appends a line to the endpoint's
+    manifest.jsonl recording the request it answered (including the time
+    window and offset), the object it is stored in, the record count and when
+    it was fetched."""
+
+    root: str
+    compresslevel: int
+
+    def __init__(self, root: str, compresslevel: int = 6) -> None:
+        self.root = root
+        self.compresslevel = compresslevel
+
+    def _manifest_path(self, endpoint: str) -> str:
+        return os.path.join(self.root, endpoint, "manifest.jsonl")
+
+    def endpoints(self) -> list[str]:
+        """Endpoints that have a manifest in this archive"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            e for e in os.listdir(self.root) if os.path.exists(self._manifest_path(e))
+        )
+
+    @classmethod
+    def from_env(cls) -> "Archive | None":
+        root = os.getenv("ARCHIVE_DIR")
+        if not root:
+            return None
+        return cls(root, int(os.getenv("ARCHIVE_COMPRESSLEVEL", "6")))
+
+    def manifest(self, endpoint: str) -> typing.Iterator[dict]:
+        """Yield the manifest entries for an endpoint, oldest first"""
+        path = self._manifest_path(endpoint)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def object_path(self, endpoint: str, digest: str) -> str:
+        return os.path.join(
+            self.root, endpoint, "objects", digest[:2], f"{digest}.ndjson.gz"
+        )
+
+    def read(self, endpoint: str, digest: str) -> typing.Iterator[dict]:
+        """Yield the records of one archived page"""
+        with gzip.open(self.object_path(endpoint, digest), "rt") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def write(self, endpoint: str, params: dict, records: list[dict]) -> str:
+        """Archive one page of records and return its digest"""
+        data = "".join(
+            json.dumps(r, separators=(",", ":")) + "\n" for r in records
+        ).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(endpoint, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # mtime=0 keeps the compressed bytes the same for the same page
+            compressed = gzip.compress(data, self.compresslevel, mtime=0)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp, path)
+        entry = {
+            "endpoint": endpoint,
+            "params": params,
+            "sha256": digest,
+            "records": len(records),
+            "fetched_at": datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        }
+        # one write per line under an exclusive lock, so concurrent writers
+        # never interleave their entries
+        with open(self._manifest_path(endpoint), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        log.debug(f"Archived {len(records)} {endpoint} records as {digest}")
+        return digest
@@ -0,0 +1,261 @@
+"""End-to-end ingestion benchmarks for the get-*.py jobs
+
+Runs each job's main_job against mock-seismic-api.py and a PostgreSQL
+database at several data scales, and reports throughput, API request latency
+percentiles, time spent in HTTP, JSON decoding and database writes, and peak
+memory. Every job runs in its own process so that peak RSS belongs to that job
+alone. Tables are created in a separate seismic_benchmark schema of the
+database in BENCHMARK_DB, and emptied before each run.
+
+    uv run benchmarks/ingest.py --scales 10000,1000000 get-library-contents
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import typing
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2  # noqa: E402
+import psycopg2.sql  # noqa: E402
+
+JOBS = (
+    "get-content-usage-history",
+    "get-content-view-history",
+    "get-library-content-versions",
+    "get-library-contents",
+    "get-search-history",
+    "get-users",
+    "get-workspace-content-versions",
+    "get-workspace-contents",
+)
+BENCHMARK_SCHEMA = "seismic_benchmark"
+
+
+def _columns(job: object) -> list[tuple[str, str]]:
+    # (column, type) pairs for the table a job writes to
+    if hasattr(job, "SCHEMA"):
+        return [
+            (c, f.type)
+            for c, f in zip(job.SCHEMA.columns, job.SCHEMA.fields, strict=True)
+        ]
+    return [
+        *((c, "text") for c in job.COLUMNS),
+        ("_deleted", "boolean"),
+        ("_synced", "boolean"),
+    ]
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list[float], p: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100)[p - 1]
+
+
+def prepare(dsn: str, job: object) -> None:
+    """Create the job's table in the benchmark schema, empty"""
+    sql = psycopg2.sql
+    table = sql.Identifier(BENCHMARK_SCHEMA, job.TABLE)
+    columns = sql.SQL(", ").join(
+        sql.SQL("{} {}{}").format(
+            sql.Identifier(c),
+            sql.SQL(t),
+            sql.SQL(" primary key" if c == "id" else ""),
+        )
+        for c, t in _columns(job)
+    )
+    cnx = psycopg2.connect(dsn)
+    try:
+        with cnx, cnx.cursor() as cur:
+            cur.execute(
+                sql.SQL("create schema if not exists {}").format(
+                    sql.Identifier(BENCHMARK_SCHEMA)
+                )
+            )
+            cur.execute(sql.SQL("drop table if exists {}").format(table))
+            cur.execute(sql.SQL("create table {} ({})").format(table, columns))
+            cur.execute(
+                sql.SQL("drop table if exists {}").format(
+                    sql.Identifier(BENCHMARK_SCHEMA, "seismic_sync_watermarks")
+                )
+            )
+    finally:
+        cnx.close()
+
+
+def run_one(name: str) -> dict:
+    """Run one job's main_job in this process and measure it"""
+    import db
+    import seismic
+
+    timings = {"http": 0.0, "json": 0.0, "db": 0.0}
+    latencies = []
+
+    class TimedClient(seismic.SeismicClient):
+        def _get(self, *args: object, **kwargs: object) -> object:
+            started = time.perf_counter()
+            try:
+                return super()._get(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                latencies.append(elapsed)
+                timings["http"] += elapsed
+
+        def _get_json(self, *args: object, **kwargs: object) -> list[dict]:
+            http = timings["http"]
+            started = time.perf_counter()
+            try:
+                return super()._get_json(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                timings["json"] += elapsed - (timings["http"] - http)
+
+    def timed(f: typing.Callable) -> typing.Callable:
+        def wrapper(*args: object, **kwargs: object) -> object:
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timings["db"] += time.perf_counter() - started
+
+        return wrapper
+
+    db.upsert_rows = timed(db.upsert_rows)
+    db.upsert_csv = timed(db.upsert_csv)
+
+    job = importlib.import_module(name)
+    db.ensure_watermarks()
+    with TimedClient.from_env() as c:
+        started = time.perf_counter()
+        job.main_job(c)
+        seconds = time.perf_counter() - started
+    with db.connection() as cnx, cnx, cnx.cursor() as cur:
+        cur.execute(
+            psycopg2.sql.SQL("select count(*) from {}").format(
+                psycopg2.sql.Identifier(job.TABLE)
+            )
+        )
+        records = cur.fetchone()[0]
+    db.close_pool()
+    return {
+        "job": name,
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_second": round(records / seconds, 1),
+        "requests": len(latencies),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "http_seconds": round(timings["http"], 3),
+        "json_seconds": round(timings["json"], 3),
+        "db_seconds": round(timings["db"], 3),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+@contextlib.contextmanager
+def mock_api(records: int, users: int, latency_ms: float) -> typing.Iterator[str]:
+    """Run mock-seismic-api.py in its own process and yield its URL"""
+    port = _free_port()
+    env = {
+        **os.environ,
+        "MOCK_PORT": str(port),
+        "MOCK_RECORDS": str(records),
+        "MOCK_USERS": str(users),
+        "MOCK_LATENCY_MS": str(latency_ms),
+    }
+    script = os.path.join(ROOT, "mock-seismic-api.py")
+    proc = subprocess.Popen([sys.executable, script], env=env)  # noqa: S603
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "jobs", nargs="*", default=JOBS, help="jobs to run (default all)"
+    )
+    parser.add_argument(
+        "--scales",
+        default="10000,100000",
+        help="comma-separated records per endpoint (default 10000,100000)",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0, help="mock API latency")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one)))
+        return
+
+    dsn = os.getenv("BENCHMARK_DB")
+    if not dsn:
+        sys.exit("Set BENCHMARK_DB to a PostgreSQL connection string")
+
+    results = []
+    for scale in (int(s) for s in args.scales.split(",")):
+        with mock_api(scale, scale, args.latency_ms) as url:
+            for name in args.jobs:
+                prepare(dsn, importlib.import_module(name))
+                env = {
+                    **os.environ,
+                    "DB": dsn,
+                    "PGOPTIONS": f"-c search_path={BENCHMARK_SCHEMA}",
+                    "SEISMIC_API_URL": url,
+                    "SEISMIC_AUTH_URL": url,
+                    "CLIENT_ID": str(uuid.uuid4()),
+                    "CLIENT_SECRET": str(uuid.uuid4()),
+                    "TENANT": "benchmark",
+                    "USER_ID": str(uuid.uuid4()),
+                }
+                out = subprocess.run(  # noqa: S603
+                    [sys.executable, __file__, "--run-one", name],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+                result = {"scale": scale, **json.loads(out.stdout.splitlines()[-1])}
+                print(json.dumps(result), flush=True)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
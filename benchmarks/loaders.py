@@ -0,0 +1,253 @@
+"""Micro-benchmarks for the ways of upserting rows into the raw tables
+
+Loads synthetic rows for every job's table with each write strategy:
+execute_batch, execute_values and a prepared statement at several page sizes,
+and db.upsert_rows (COPY into a staging table and a set-based merge), which
+is what the jobs use today. Every strategy runs against an empty table
+(insert-heavy) and against a table that already holds every id with older
+values (update-heavy). The last lines name the fastest strategy for each
+table over both runs. Tables are created in the seismic_benchmark schema of
+the database in BENCHMARK_DB, and emptied before each run.
+
+    uv run benchmarks/loaders.py --rows 50000 get-users
+"""
+
+import argparse
+import functools
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ingest  # noqa: E402
+import psycopg2  # noqa: E402
+import psycopg2.extras  # noqa: E402
+import psycopg2.sql  # noqa: E402
+
+import db  # noqa: E402
+
+mock = importlib.import_module("mock-seismic-api")
+
+
+def _columns(job: object) -> tuple[str, ...]:
+    if hasattr(job, "SCHEMA"):
+        return job.SCHEMA.columns
+    return (*job.COLUMNS, "_deleted", "_synced")
+
+
+def _rows(job: object, count: int, offset: int = 0) -> list[tuple]:
+    # count rows for a job's table; rows with a different offset have the
+    # same ids but different values
+    api = mock.MockSeismic(records=count + offset, users=count + offset)
+    if hasattr(job, "SCHEMA"):
+        data = mock.Dataset(job.ENDPOINT, api.records, api.start, api.end)
+        records = []
+        for i in range(count):
+            record = {f.name: data.value(f.name, i + offset) for f in job.SCHEMA.fields}
+            record["id"] = data.id(i)
+            records.append(record)
+        return list(job.SCHEMA.rows(records))
+    rows = []
+    for i in range(count):
+        u = api.scim_user(i + offset)
+        u["id"] = api.users.id(i)
+        record = job._user_record(u)
+        rows.append((*(record.get(c) for c in job.COLUMNS), False, True))
+    return rows
+
+
+def _upsert_query(
+    table: str, columns: typing.Sequence[str], values: psycopg2.sql.Composable
+) -> psycopg2.sql.Composed:
+    # the same conflict handling as db.merge_stage, one statement per page
+    sql = psycopg2.sql
+    updated = [c for c in columns if c != "id"]
+    return sql.SQL("""
+        insert into {table} ({columns}) values {values}
+        on conflict (id) do update set {assignments}
+        where row({current}) is distinct from row({incoming})
+    """).format(
+        table=sql.Identifier(table),
+        columns=sql.SQL(", ").join(map(sql.Identifier, columns)),
+        values=values,
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{0} = excluded.{0}").format(sql.Identifier(c)) for c in updated
+        ),
+        current=sql.SQL(", ").join(sql.Identifier(table, c) for c in updated),
+        incoming=sql.SQL(", ").join(sql.Identifier("excluded", c) for c in updated),
+    )
+
+
+def copy_merge(
+    cur: psycopg2.extensions.cursor,
+    table: str,
+    columns: typing.Sequence[str],
+    rows: list[tuple],
+) -> None:
+    db.upsert_rows(cur, table, columns, rows)
+
+
+def execute_batch(
+    cur: psycopg2.extensions.cursor,
+    table: str,
+    columns: typing.Sequence[str],
+    rows: list[tuple],
+    page_size: int,
+) -> None:
+    placeholders = psycopg2.sql.SQL("({})").format(
+        psycopg2.sql.SQL(", ").join(psycopg2.sql.Placeholder() * len(columns))
+    )
+    query = _upsert_query(table, columns, placeholders)
+    psycopg2.extras.execute_batch(cur, query, rows, page_size=page_size)
+
+
+def execute_values(
+    cur: psycopg2.extensions.cursor,
+    table: str,
+    columns: typing.Sequence[str],
+    rows: list[tuple],
+    page_size: int,
+) -> None:
+    query = _upsert_query(table, columns, psycopg2.sql.SQL("%s"))
+    psycopg2.extras.execute_values(cur, query, rows, page_size=page_size)
+
+
+def prepared(
+    cur: psycopg2.extensions.cursor,
+    table: str,
+    columns: typing.Sequence[str],
+    rows: list[tuple],
+    page_size: int,
+) -> None:
+    sql = psycopg2.sql
+    parameters = sql.SQL("({})").format(
+        sql.SQL(", ").join(sql.SQL(f"${i}") for i in range(1, len(columns) + 1))
+    )
+    cur.execute(
+        sql.SQL("prepare _upsert as {}").format(
+            _upsert_query(table, columns, parameters)
+        )
+    )
+    try:
+        execute = sql.SQL("execute _upsert ({})").format(
+            sql.SQL(", ").join(sql.Placeholder() * len(columns))
+        )
+        psycopg2.extras.execute_batch(cur, execute, rows, page_size=page_size)
+    finally:
+        cur.execute("deallocate _upsert")
+
+
+def strategies(page_sizes: list[int]) -> dict[str, typing.Callable]:
+    result = {"copy_merge": copy_merge}
+    for f in (execute_batch, execute_values, prepared):
+        for page_size in page_sizes:
+            result[f"{f.__name__}_{page_size}"] = functools.partial(
+                f, page_size=page_size
+            )
+    return result
+
+
+def run(
+    dsn: str,
+    job: object,
+    load: typing.Callable,
+    rows: list[tuple],
+    existing: list[tuple],
+    batch: int,
+) -> float:
+    """Load rows into a fresh table in batches and return the seconds taken"""
+    ingest.prepare(dsn, job)
+    columns = _columns(job)
+    cnx = psycopg2.connect(dsn, options=f"-c search_path={ingest.BENCHMARK_SCHEMA}")
+    try:
+        if existing:
+            with cnx, cnx.cursor() as cur:
+                copy_merge(cur, job.TABLE, columns, existing)
+                cur.execute(
+                    psycopg2.sql.SQL("analyze {}").format(
+                        psycopg2.sql.Identifier(job.TABLE)
+                    )
+                )
+        started = time.perf_counter()
+        # one transaction per batch, as the jobs commit once per page or window
+        for i in range(0, len(rows), batch):
+            with cnx, cnx.cursor() as cur:
+                load(cur, job.TABLE, columns, rows[i : i + batch])
+        return time.perf_counter() - started
+    finally:
+        cnx.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "jobs",
+        nargs="*",
+        default=ingest.JOBS,
+        help="jobs whose tables to load (default all)",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=10000, help="rows per run (default 10000)"
+    )
+    parser.add_argument(
+        "--batch", type=int, default=1000, help="rows per transaction (default 1000)"
+    )
+    parser.add_argument(
+        "--page-sizes",
+        default="100,1000",
+        help="comma-separated page sizes (default 100,1000)",
+    )
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    dsn = os.getenv("BENCHMARK_DB")
+    if not dsn:
+        sys.exit("Set BENCHMARK_DB to a PostgreSQL connection string")
+    # db.upsert_rows logs every batch
+    logging.getLogger("db").setLevel(logging.WARNING)
+
+    loaders = strategies([int(s) for s in args.page_sizes.split(",")])
+    results = []
+    defaults = []
+    for name in args.jobs:
+        job = importlib.import_module(name)
+        existing = _rows(job, args.rows)
+        scenarios = {
+            "insert": ([], existing),
+            "update": (existing, _rows(job, args.rows, args.rows)),
+        }
+        totals = dict.fromkeys(loaders, 0.0)
+        for scenario, (before, rows) in scenarios.items():
+            for strategy, load in loaders.items():
+                seconds = run(dsn, job, load, rows, before, args.batch)
+                totals[strategy] += seconds
+                result = {
+                    "table": job.TABLE,
+                    "scenario": scenario,
+                    "strategy": strategy,
+                    "rows": len(rows),
+                    "seconds": round(seconds, 3),
+                    "rows_per_second": round(len(rows) / seconds, 1),
+                }
+                print(json.dumps(result), flush=True)
+                results.append(result)
+        best = min(totals, key=totals.get)
+        defaults.append(
+            {"table": job.TABLE, "default": best, "seconds": round(totals[best], 3)}
+        )
+
+    for d in defaults:
+        print(json.dumps(d))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"results": results, "defaults": defaults}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
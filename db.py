@@ -0,0 +1,540 @@
+import contextlib
+import csv
+import datetime
+import functools
+import io
+import json
+import logging
+import operator
+import os
+import re
+import threading
+import time
+import typing
+
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import psycopg2.sql
+
+log = logging.getLogger(__name__)
+
+_pool: psycopg2.pool.ThreadedConnectionPool | None = None
+_pool_lock = threading.Lock()
+# one slot per connection the pool may hand out, so that borrowers wait for a
+# free connection instead of getting "connection pool exhausted"
+_pool_slots: threading.BoundedSemaphore | None = None
+_last_used: dict[int, float] = {}
+
+
+class Field(typing.NamedTuple):
+    """One API field of a reporting record and the column it is stored in
+
+    column defaults to the snake_case form of name. Values of array and json
+    columns are converted to their COPY text form; everything else is written
+    as it comes from the API."""
+
+    name: str
+    type: str = "text"
+    column: str | None = None
+
+
+class MergeCounts(typing.NamedTuple):
+    inserted: int
+    updated: int
+    unchanged: int
+
+    def __str__(self) -> str:
+        return (
+            f"{self.inserted} inserted, {self.updated} updated, "
+            f"{self.unchanged} unchanged"
+        )
+
+
+class Schema:
+    """A declarative mapping from reporting API records to a raw table
+
+    fields are Field objects, or plain API field names for text columns. The
+    row extractor is compiled once: a single operator.itemgetter pulls every
+    field out of a record, and only the fields that need it are converted."""
+
+    def __init__(self, table: str, fields: typing.Iterable[Field | str]) -> None:
+        self.table = table
+        self.fields = tuple(Field(f) if isinstance(f, str) else f for f in fields)
+        self.columns = tuple(f.column or snake_case(f.name) for f in self.fields)
+        self._names = tuple(f.name for f in self.fields)
+        self._getter = operator.itemgetter(*self._names)
+        self._converters = tuple(
+            (i, _CONVERTERS[f.type])
+            for i, f in enumerate(self.fields)
+            if f.type in _CONVERTERS
+        )
+
+    def row(self, record: dict) -> typing.Sequence:
+        try:
+            values = self._getter(record)
+        except KeyError:
+            # the API leaves out some fields on some records
+            values = tuple(record.get(n) for n in self._names)
+        if self._converters:
+            values = list(values)
+            for i, convert in self._converters:
+                if values[i] is not None:
+                    values[i] = convert(values[i])
+        return values
+
+    def rows(self, records: typing.Iterable[dict]) -> typing.Iterator[typing.Sequence]:
+        return map(self.row, records)
+
+
+class _ChunkReader:
+    # A minimal file-like object over an iterator of text chunks, so that a
+    # streamed HTTP response body can be handed directly to copy_expert
+
+    def __init__(self, chunks: typing.Iterable[str]) -> None:
+        self._chunks = iter(chunks)
+        self._buf = ""
+
+    def _fill(self, size: int) -> None:
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+
+    def read(self, size: int = -1) -> str:
+        self._fill(size)
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def readline(self) -> str:
+        while "\n" not in self._buf:
+            before = len(self._buf)
+            self._fill(before + 1)
+            if len(self._buf) == before:
+                break
+        end = self._buf.find("\n") + 1 or len(self._buf)
+        line, self._buf = self._buf[:end], self._buf[end:]
+        return line
+
+
+def _array_columns(cur: psycopg2.extensions.cursor, table: str) -> dict[str, str]:
+    # Array columns of a table and their types, for example facet_values: text[]
+    sql = """
+        select a.attname, format_type(a.atttypid, a.atttypmod)
+        from pg_attribute a
+        join pg_type t on t.oid = a.atttypid
+        where a.attrelid = %(table)s::regclass
+        and a.attnum > 0
+        and not a.attisdropped
+        and t.typcategory = 'A'
+    """
+    cur.execute(sql, {"table": table})
+    return {name: type_name for name, type_name in cur.fetchall()}
+
+
+def _array_literal(values: typing.Iterable | str) -> str:
+    # PostgreSQL array input syntax, for example {"a","b",NULL}
+    if isinstance(values, str):
+        return values
+    items = (
+        "NULL"
+        if v is None
+        else '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for v in values
+    )
+    return "{" + ",".join(items) + "}"
+
+
+_CONVERTERS = {
+    "json": json.dumps,
+    "jsonb": json.dumps,
+    "text[]": _array_literal,
+}
+
+
+@functools.cache
+def _copy_query(table: str, columns: tuple[str, ...]) -> psycopg2.sql.Composed:
+    return psycopg2.sql.SQL("copy {} ({}) from stdin with (format csv)").format(
+        psycopg2.sql.Identifier(f"_stage_{table}"),
+        psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, columns)),
+    )
+
+
+def _copy_value(value: object) -> object:
+    # csv.writer would write True/False and Python list reprs; COPY (and the
+    # text columns execute_batch used to fill) expect true/false and arrays
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, list):
+        return _array_literal(value)
+    return value
+
+
+def _healthy(cnx: psycopg2.extensions.connection) -> bool:
+    # Connections that sat idle in the pool for a while may have been dropped
+    # by the server or a proxy, so check them before handing them out
+    if cnx.closed:
+        return False
+    idle = time.monotonic() - _last_used.get(id(cnx), 0)
+    if idle < float(os.getenv("DB_POOL_CHECK_AFTER_SECONDS", "30")):
+        return True
+    try:
+        with cnx.cursor() as cur:
+            cur.execute("select 1")
+        cnx.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+@functools.cache
+def _merge_query(table: str, columns: tuple[str, ...]) -> psycopg2.sql.Composed:
+    column_list = psycopg2.sql.SQL(", ").join(map(psycopg2.sql.Identifier, columns))
+    updated_columns = [c for c in columns if c != "id"]
+    assignments = psycopg2.sql.SQL(", ").join(
+        psycopg2.sql.SQL("{0} = excluded.{0}").format(psycopg2.sql.Identifier(c))
+        for c in updated_columns
+    )
+    current = psycopg2.sql.SQL(", ").join(
+        psycopg2.sql.Identifier(table, c) for c in updated_columns
+    )
+    incoming = psycopg2.sql.SQL(", ").join(
+        psycopg2.sql.Identifier("excluded", c) for c in updated_columns
+    )
+    # xmax is 0 for a freshly inserted row version and set for an updated one
+    return psycopg2.sql.SQL("""
+        with merged as (
+            insert into {table} ({columns})
+            select distinct on (id) {columns}
+            from {stage}
+            order by id, ctid desc
+            on conflict (id) do update set {assignments}
+            where row({current}) is distinct from row({incoming})
+            returning xmax = 0 inserted
+        )
+        select
+            count(*) filter (where inserted) inserted,
+            count(*) filter (where not inserted) updated,
+            (select count(distinct id) from {stage}) - count(*) unchanged
+        from merged
+    """).format(
+        table=psycopg2.sql.Identifier(table),
+        columns=column_list,
+        stage=psycopg2.sql.Identifier(f"_stage_{table}"),
+        assignments=assignments,
+        current=current,
+        incoming=incoming,
+    )
+
+
+def _plural(n: int, word: str) -> str:
+    if n == 1:
+        return f"{n} {word}"
+    return f"{n} {word}s"
+
+
+def close_pool() -> None:
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+
+
+@contextlib.contextmanager
+def connection() -> typing.Iterator[psycopg2.extensions.connection]:
+    """Borrow a database connection from the process-wide pool
+
+    The connection goes back to the pool when the block exits, so it can be
+    reused by later scheduled runs instead of opening a new one each time.
+    When all DB_POOL_MAX connections are in use, this waits for one to be
+    returned."""
+
+    pool = get_pool()
+    slots = _pool_slots
+    slots.acquire()
+    try:
+        cnx = pool.getconn()
+        while not _healthy(cnx):
+            log.info("Replacing a broken database connection")
+            pool.putconn(cnx, close=True)
+            cnx = pool.getconn()
+        try:
+            yield cnx
+        finally:
+            _last_used[id(cnx)] = time.monotonic()
+            pool.putconn(cnx, close=bool(cnx.closed))
+    finally:
+        slots.release()
+
+
+def create_stage(
+    cur: psycopg2.extensions.cursor, stage: psycopg2.sql.Identifier, table: str
+) -> None:
+    # A temporary table with the same columns and types as the target table,
+    # dropped automatically when the transaction ends
+    query = psycopg2.sql.SQL(
+        "create temp table if not exists {} (like {} including defaults) on commit drop"
+    ).format(stage, psycopg2.sql.Identifier(table))
+    cur.execute(query)
+
+
+def delete_watermark(cur: psycopg2.extensions.cursor, endpoint: str) -> None:
+    sql = """
+        delete from seismic_sync_watermarks
+        where endpoint = %(endpoint)s
+    """
+    cur.execute(sql, {"endpoint": endpoint})
+
+
+def ensure_watermarks() -> None:
+    """Create the watermark table if it does not exist yet
+
+    Call this once at startup. The existence check comes first so that jobs
+    running as a user without CREATE privilege on the schema can start once
+    the table has been created."""
+
+    with connection() as cnx, cnx, cnx.cursor() as cur:
+        cur.execute("select to_regclass('seismic_sync_watermarks') is not null")
+        if cur.fetchone()[0]:
+            return
+        cur.execute("""
+            create table if not exists seismic_sync_watermarks (
+                endpoint text primary key,
+                watermark timestamptz not null,
+                updated_at timestamptz not null default now()
+            )
+        """)
+
+
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Return the process-wide connection pool, creating it on first use
+
+    DB_POOL_MIN connections are opened up front and at most DB_POOL_MAX are
+    open at once."""
+
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                int(os.getenv("DB_POOL_MIN", "1")),
+                int(os.getenv("DB_POOL_MAX", "4")),
+                os.getenv("DB"),
+                cursor_factory=psycopg2.extras.DictCursor,
+            )
+            _pool_slots = threading.BoundedSemaphore(_pool.maxconn)
+    return _pool
+
+
+def get_start(
+    cur: psycopg2.extensions.cursor,
+    endpoint: str,
+    table: str,
+    default: datetime.datetime,
+) -> datetime.datetime:
+    """Return where a sync of endpoint into table carries on from
+
+    That is the endpoint's watermark, or before there is one the newest
+    modified_at already loaded into table, or default when table is empty."""
+
+    watermark = get_watermark(cur, endpoint)
+    if watermark is not None:
+        return watermark
+    query = psycopg2.sql.SQL("select max(modified_at)::timestamptz from {}").format(
+        psycopg2.sql.Identifier(table)
+    )
+    cur.execute(query)
+    newest = cur.fetchone()[0]
+    if newest is None:
+        return default
+    return newest
+
+
+def get_watermark(
+    cur: psycopg2.extensions.cursor, endpoint: str
+) -> datetime.datetime | None:
+    """Return the sync watermark for an endpoint, or None if there is none yet"""
+
+    sql = """
+        select watermark
+        from seismic_sync_watermarks
+        where endpoint = %(endpoint)s
+    """
+    cur.execute(sql, {"endpoint": endpoint})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def merge_stage(
+    cur: psycopg2.extensions.cursor, table: str, columns: typing.Sequence[str]
+) -> MergeCounts:
+    """Merge the staging table for table into it and count what changed
+
+    distinct on (id) keeps the last copy of a record that appears more than
+    once in a batch, which insert ... on conflict would otherwise reject.
+    Existing rows are only rewritten when at least one column differs, so
+    re-fetched records that did not change produce no dead tuples or WAL.
+    The query is built once for each table and column list."""
+
+    cur.execute(_merge_query(table, tuple(columns)))
+    return MergeCounts(*cur.fetchone())
+
+
+def set_watermark(
+    cur: psycopg2.extensions.cursor, endpoint: str, watermark: datetime.datetime
+) -> None:
+    # Run this in the same transaction as the data it covers; the watermark
+    # never moves backwards
+    sql = """
+        insert into seismic_sync_watermarks (endpoint, watermark)
+        values (%(endpoint)s, %(watermark)s)
+        on conflict (endpoint) do update set
+            watermark = greatest(
+                seismic_sync_watermarks.watermark, excluded.watermark
+            ),
+            updated_at = now()
+    """
+    cur.execute(sql, {"endpoint": endpoint, "watermark": watermark})
+
+
+def set_watermark_from_stage(
+    cur: psycopg2.extensions.cursor, endpoint: str, table: str
+) -> None:
+    # Advance the watermark to the latest modified_at in the batch that was
+    # just merged into table
+    query = psycopg2.sql.SQL("""
+        insert into seismic_sync_watermarks (endpoint, watermark)
+        select %(endpoint)s, max(modified_at)::timestamptz
+        from {stage}
+        having max(modified_at) is not null
+        on conflict (endpoint) do update set
+            watermark = greatest(
+                seismic_sync_watermarks.watermark, excluded.watermark
+            ),
+            updated_at = now()
+    """).format(stage=psycopg2.sql.Identifier(f"_stage_{table}"))
+    cur.execute(query, {"endpoint": endpoint})
+
+
+def snake_case(name: str) -> str:
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def table_columns(cur: psycopg2.extensions.cursor, table: str) -> list[str]:
+    query = psycopg2.sql.SQL("select * from {} limit 0").format(
+        psycopg2.sql.Identifier(table)
+    )
+    cur.execute(query)
+    return [d.name for d in cur.description]
+
+
+def upsert_csv(
+    cur: psycopg2.extensions.cursor, table: str, chunks: typing.Iterable[str]
+) -> int:
+    """Load a CSV body from the reporting API into a raw table
+
+    The CSV is copied into a temporary staging table and merged into the
+    target table with a single insert ... on conflict. CSV headers are API
+    field names (camelCase) and are matched to snake_case table columns. CSV
+    columns that do not exist in the table are loaded and then ignored.
+    Array columns are loaded as text first and converted in the staging
+    table, so they can arrive either as {"a","b"} or as JSON ["a","b"]."""
+
+    reader = _ChunkReader(chunks)
+    header = next(csv.reader([reader.readline()]), [])
+    if not header:
+        log.info(f"Saved 0 records to {table}")
+        return 0
+
+    target_columns = table_columns(cur, table)
+    csv_columns = []
+    extra_columns = []
+    for i, field in enumerate(header):
+        column = snake_case(field)
+        if column not in target_columns:
+            column = f"_extra_{i}"
+            extra_columns.append(column)
+        csv_columns.append(column)
+    columns = [c for c in csv_columns if c not in extra_columns]
+
+    stage = psycopg2.sql.Identifier(f"_stage_{table}")
+    cur.execute(psycopg2.sql.SQL("drop table if exists {}").format(stage))
+    create_stage(cur, stage, table)
+    for column in extra_columns:
+        cur.execute(
+            psycopg2.sql.SQL("alter table {} add column {} text").format(
+                stage, psycopg2.sql.Identifier(column)
+            )
+        )
+    arrays = {c: t for c, t in _array_columns(cur, table).items() if c in columns}
+    for column in arrays:
+        cur.execute(
+            psycopg2.sql.SQL("alter table {} alter column {} type text").format(
+                stage, psycopg2.sql.Identifier(column)
+            )
+        )
+    cur.copy_expert(_copy_query(table, tuple(csv_columns)), reader)
+    count = cur.rowcount
+    for column, type_name in arrays.items():
+        query = psycopg2.sql.SQL("""
+            update {stage} set {column} = array(
+                select jsonb_array_elements_text({column}::jsonb)
+            )::text
+            where {column} like '[%'
+        """).format(stage=stage, column=psycopg2.sql.Identifier(column))
+        cur.execute(query)
+        query = psycopg2.sql.SQL(
+            "alter table {stage} alter column {c} type {t} using {c}::{t}"
+        ).format(
+            stage=stage,
+            c=psycopg2.sql.Identifier(column),
+            t=psycopg2.sql.SQL(type_name),
+        )
+        cur.execute(query)
+    counts = merge_stage(cur, table, columns)
+    log.info(f"Saved {_plural(count, 'record')} to {table}: {counts}")
+    return count
+
+
+def upsert_records(
+    cur: psycopg2.extensions.cursor, schema: Schema, records: typing.Iterable[dict]
+) -> int:
+    """Upsert reporting API records into the raw table described by schema"""
+    return upsert_rows(cur, schema.table, schema.columns, schema.rows(records))
+
+
+def upsert_rows(
+    cur: psycopg2.extensions.cursor,
+    table: str,
+    columns: typing.Sequence[str],
+    rows: typing.Iterable[typing.Sequence],
+) -> int:
+    """Upsert rows into a table with COPY and a set-based merge
+
+    Rows are written to an in-memory CSV buffer, copied into a temporary
+    staging table and merged into the target table with a single
+    insert ... on conflict (id) do update."""
+
+    buf = io.StringIO()
+    # QUOTE_NOTNULL leaves None unquoted, which COPY reads as null, and quotes
+    # everything else so that empty strings stay empty strings
+    writer = csv.writer(buf, quoting=csv.QUOTE_NOTNULL)
+    writer.writerows([_copy_value(v) for v in row] for row in rows)
+    buf.seek(0)
+
+    stage = psycopg2.sql.Identifier(f"_stage_{table}")
+    create_stage(cur, stage, table)
+    cur.execute(psycopg2.sql.SQL("truncate {}").format(stage))
+    cur.copy_expert(_copy_query(table, tuple(columns)), buf)
+    count = cur.rowcount
+    counts = merge_stage(cur, table, columns)
+    log.info(f"Saved {_plural(count, 'record')} to {table}: {counts}")
+    return count
@@ -1,98 +1,93 @@
 import datetime
 import logging
-import os
 import signal
 import sys
 import types
-import uuid
 
-import apscheduler.schedulers.blocking
 import notch
 import psycopg2.extras
 
+import db
 import seismic
+import sync
 
 notch.configure()
 log = logging.getLogger(__name__)
 
 
-def batch_upsert_records(cur: psycopg2.extras.DictCursor, records: list[dict]) -> None:
-    sql = """
-        insert into seismic_content_view_history_raw (
-            id, action, application, content_id, content_version_id,
-            content_profile_id, content_profile_name, context_id,
-            context_name, context_type, context_system_type, instance_name,
-            library_content_id, library_content_version_id, occurred_at,
-            product_area, user_id, user_username, workspace_content_id,
-            workspace_content_version_id, modified_at
-        ) values (
-            %(id)s, %(action)s, %(application)s, %(contentId)s, %(contentVersionId)s,
-            %(contentProfileId)s, %(contentProfileName)s, %(contextId)s,
-            %(contextName)s, %(contextType)s, %(contextSystemType)s, %(instanceName)s,
-            %(libraryContentId)s, %(libraryContentVersionId)s, %(occurredAt)s,
-            %(productArea)s, %(userId)s, %(userUsername)s, %(workspaceContentId)s,
-            %(workspaceContentVersionId)s, %(modifiedAt)s
-        ) on conflict (id) do update set
-            action = %(action)s, application = %(application)s,
-            content_id = %(contentId)s, content_version_id = %(contentVersionId)s,
-            content_profile_id = %(contentProfileId)s,
-            content_profile_name = %(contentProfileName)s, context_id = %(contextId)s,
-            context_name = %(contextName)s, context_type = %(contextType)s,
-            context_system_type = %(contextSystemType)s,
-            instance_name = %(instanceName)s, library_content_id = %(libraryContentId)s,
-            library_content_version_id = %(libraryContentVersionId)s,
-            occurred_at = %(occurredAt)s, product_area = %(productArea)s,
-            user_id = %(userId)s, user_username = %(userUsername)s,
-            workspace_content_id = %(workspaceContentId)s,
-            workspace_content_version_id = %(workspaceContentVersionId)s,
-            modified_at = %(modifiedAt)s
-    """
-    plural = "s"
-    if len(records) == 1:
-        plural = ""
-    log.info(f"Saving {len(records)} record{plural} to database")
-    psycopg2.extras.execute_batch(cur, sql, records)
-
-
-def get_max_modified_at(cur: psycopg2.extras.DictCursor) -> datetime.datetime:
-    sql = """
-        select max(modified_at)::timestamptz max_modified_at
-        from seismic_content_view_history_raw
-    """
-    cur.execute(sql)
-    row = cur.fetchone()
-    val = row.get("max_modified_at")
-    if val is None:
-        val = datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC)
-    return val
-
-
-def main_job(repeat_interval_hours: int | None = None) -> None:
-    log.info("Running the main job")
-
-    cnx = psycopg2.connect(os.getenv("DB"), cursor_factory=psycopg2.extras.DictCursor)
+ENDPOINT = "contentViewHistory"
+TABLE = "seismic_content_view_history_raw"
+
+SCHEMA = db.Schema(
+    TABLE,
+    (
+        "id",
+        "action",
+        "application",
+        "contentId",
+        "contentVersionId",
+        "contentProfileId",
+        "contentProfileName",
+        "contextId",
+        "contextName",
+        "contextType",
+        "contextSystemType",
+        "instanceName",
+        "libraryContentId",
+        "libraryContentVersionId",
+        "occurredAt",
+        "productArea",
+        "userId",
+        "userUsername",
+        "workspaceContentId",
+        "workspaceContentVersionId",
+        "modifiedAt",
+    ),
+)
 
-    with cnx:
-        with cnx.cursor() as cur:
-            max_modified_at = get_max_modified_at(cur)
-    max_modified_at_s = max_modified_at.strftime("%Y-%m-%dT%H:%M:%S")
 
-    params = {
-        "modifiedAtStartTime": max_modified_at_s,
-    }
-
-    log.info(f"Looking for content view history modified after {max_modified_at_s}")
+def batch_upsert_records(cur: psycopg2.extras.DictCursor, records: list[dict]) -> None:
+    db.upsert_records(cur, SCHEMA, records)
 
-    client_id = uuid.UUID(hex=os.getenv("CLIENT_ID"))
-    client_secret = uuid.UUID(hex=os.getenv("CLIENT_SECRET"))
-    user_id = uuid.UUID(hex=os.getenv("USER_ID"))
 
-    c = seismic.SeismicClient(client_id, client_secret, os.getenv("TENANT"), user_id)
-    records = c.content_view_history(params)
+def main_job(
+    c: seismic.SeismicClient,
+    repeat_interval_hours: int | None = None,
+) -> None:
+    log.info("Running the main job")
 
-    with cnx:
-        with cnx.cursor() as cur:
-            batch_upsert_records(cur, records)
+    with db.connection() as cnx:
+        with cnx:
+            with cnx.cursor() as cur:
+                modified_at_start_time = db.get_start(
+                    cur,
+                    ENDPOINT,
+                    TABLE,
+                    datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC),
+                )
+
+        step = datetime.timedelta(days=2)
+        if c.csv_mode:
+            sync.load_windows(
+                cnx,
+                ENDPOINT,
+                TABLE,
+                modified_at_start_time,
+                step,
+                "content view history",
+                c.content_view_history_csv,
+            )
+        else:
+            sync.run_windows(
+                cnx,
+                ENDPOINT,
+                TABLE,
+                modified_at_start_time,
+                step,
+                "content view history",
+                c.content_view_history_pages,
+                batch_upsert_records,
+            )
 
     if repeat_interval_hours:
         plural = "s"
@@ -104,32 +99,10 @@ def main_job(repeat_interval_hours: int | None = None) -> None:
     log.info(f"Main job complete, {repeat_message}")
 
 
-def main() -> None:
-    repeat = os.getenv("REPEAT", "false").lower() in ("1", "on", "true", "yes")
-    if repeat:
-        repeat_interval_hours = int(os.getenv("REPEAT_INTERVAL_HOURS", "6"))
-        log.info(f"This job will repeat every {repeat_interval_hours} hours")
-        log.info(
-            "Change this value by setting the "
-            "REPEAT_INTERVAL_HOURS environment variable"
-        )
-        scheduler = apscheduler.schedulers.blocking.BlockingScheduler()
-        scheduler.add_job(
-            main_job,
-            "interval",
-            args=[repeat_interval_hours],
-            hours=repeat_interval_hours,
-        )
-        scheduler.add_job(main_job, args=[repeat_interval_hours])
-        scheduler.start()
-    else:
-        main_job()
-
-
 def handle_sigterm(_signal: int, _frame: types.FrameType) -> None:
     sys.exit()
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, handle_sigterm)
-    main()
+    sync.run_job(main_job)
@@ -1,107 +1,93 @@
 import datetime
 import logging
-import os
 import signal
 import sys
 import types
-import uuid
 
-import apscheduler.schedulers.blocking
 import notch
 import psycopg2.extras
 
+import db
 import seismic
+import sync
 
 notch.configure()
 log = logging.getLogger(__name__)
 
 
-def batch_upsert_records(cur: psycopg2.extras.DictCursor, records: list[dict]) -> None:
-    sql = """
-        insert into seismic_search_history_raw (
-            id, occurred_at, active_scope, application, result_count,
-            result_count_content_manager, result_count_control_center,
-            result_count_doc_center, result_count_news_center,
-            result_count_workspace, search_cycle_id, search_term_normalized,
-            search_term_raw, search_type, sort_by, user_id, modified_at,
-            step_index, step_type, was_clicked, facet_values
-        ) values (
-            %(id)s, %(occurredAt)s, %(activeScope)s, %(application)s, %(resultCount)s,
-            %(resultCountContentManager)s, %(resultCountControlCenter)s,
-            %(resultCountDocCenter)s, %(resultCountNewsCenter)s,
-            %(resultCountWorkspace)s, %(searchCycleId)s, %(searchTermNormalized)s,
-            %(searchTermRaw)s, %(searchType)s, %(sortBy)s, %(userId)s, %(modifiedAt)s,
-            %(stepIndex)s, %(stepType)s, %(wasClicked)s, %(facetValues)s
-        ) on conflict (id) do update set
-            occurred_at = %(occurredAt)s, active_scope = %(activeScope)s,
-            application = %(application)s, result_count = %(resultCount)s,
-            result_count_content_manager = %(resultCountContentManager)s,
-            result_count_control_center = %(resultCountControlCenter)s,
-            result_count_doc_center = %(resultCountDocCenter)s,
-            result_count_news_center = %(resultCountNewsCenter)s,
-            result_count_workspace = %(resultCountWorkspace)s,
-            search_cycle_id = %(searchCycleId)s,
-            search_term_normalized = %(searchTermNormalized)s,
-            search_term_raw = %(searchTermRaw)s, search_type = %(searchType)s,
-            sort_by = %(sortBy)s, user_id = %(userId)s, modified_at = %(modifiedAt)s,
-            step_index = %(stepIndex)s, step_type = %(stepType)s,
-            was_clicked = %(wasClicked)s, facet_values = %(facetValues)s
-    """
-    plural = "s"
-    if len(records) == 1:
-        plural = ""
-    log.info(f"Saving {len(records)} record{plural} to database")
-    psycopg2.extras.execute_batch(cur, sql, records)
-
-
-def get_max_modified_at(cur: psycopg2.extras.DictCursor) -> datetime.datetime:
-    sql = """
-        select max(modified_at)::timestamptz max_modified_at
-        from seismic_search_history_raw
-    """
-    cur.execute(sql)
-    row = cur.fetchone()
-    val = row.get("max_modified_at")
-    if val is None:
-        val = datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC)
-    return val
-
-
-def main_job(repeat_interval_hours: int | None = None) -> None:
-    log.info("Running the main job")
-
-    cnx = psycopg2.connect(os.getenv("DB"), cursor_factory=psycopg2.extras.DictCursor)
+ENDPOINT = "searchHistory"
+TABLE = "seismic_search_history_raw"
+
+SCHEMA = db.Schema(
+    TABLE,
+    (
+        "id",
+        "occurredAt",
+        "activeScope",
+        "application",
+        "resultCount",
+        "resultCountContentManager",
+        "resultCountControlCenter",
+        "resultCountDocCenter",
+        "resultCountNewsCenter",
+        "resultCountWorkspace",
+        "searchCycleId",
+        "searchTermNormalized",
+        "searchTermRaw",
+        "searchType",
+        "sortBy",
+        "userId",
+        "modifiedAt",
+        "stepIndex",
+        "stepType",
+        "wasClicked",
+        db.Field("facetValues", "text[]"),
+    ),
+)
 
-    with cnx:
-        with cnx.cursor() as cur:
-            modified_at_start_time = get_max_modified_at(cur)
 
-    client_id = uuid.UUID(hex=os.getenv("CLIENT_ID"))
-    client_secret = uuid.UUID(hex=os.getenv("CLIENT_SECRET"))
-    user_id = uuid.UUID(hex=os.getenv("USER_ID"))
-    c = seismic.SeismicClient(client_id, client_secret, os.getenv("TENANT"), user_id)
-
-    while modified_at_start_time < datetime.datetime.now(tz=datetime.UTC):
-        modified_at_end_time = modified_at_start_time + datetime.timedelta(days=2)
+def batch_upsert_records(cur: psycopg2.extras.DictCursor, records: list[dict]) -> None:
+    db.upsert_records(cur, SCHEMA, records)
 
-        modified_at_end_time_s = modified_at_end_time.strftime("%Y-%m-%dT%H:%M:%S")
-        modified_at_start_time_s = modified_at_start_time.strftime("%Y-%m-%dT%H:%M:%S")
-        log.info(
-            f"Looking for search history modified between "
-            f"{modified_at_start_time_s} and {modified_at_end_time_s}"
-        )
-        params = {
-            "modifiedAtStartTime": modified_at_start_time_s,
-            "modifiedAtEndTime": modified_at_end_time_s,
-        }
 
-        records = c.search_history(params)
+def main_job(
+    c: seismic.SeismicClient,
+    repeat_interval_hours: int | None = None,
+) -> None:
+    log.info("Running the main job")
 
+    with db.connection() as cnx:
         with cnx:
             with cnx.cursor() as cur:
-                batch_upsert_records(cur, records)
-
-        modified_at_start_time = modified_at_end_time
+                modified_at_start_time = db.get_start(
+                    cur,
+                    ENDPOINT,
+                    TABLE,
+                    datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC),
+                )
+
+        step = datetime.timedelta(days=2)
+        if c.csv_mode:
+            sync.load_windows(
+                cnx,
+                ENDPOINT,
+                TABLE,
+                modified_at_start_time,
+                step,
+                "search history",
+                c.search_history_csv,
+            )
+        else:
+            sync.run_windows(
+                cnx,
+                ENDPOINT,
+                TABLE,
+                modified_at_start_time,
+                step,
+                "search history",
+                c.search_history_pages,
+                batch_upsert_records,
+            )
 
     if repeat_interval_hours:
         plural = "s"
@@ -113,32 +99,10 @@ def main_job(repeat_interval_hours: int | None = None) -> None:
     log.info(f"Main job complete, {repeat_message}")
 
 
-def main() -> None:
-    repeat = os.getenv("REPEAT", "false").lower() in ("1", "on", "true", "yes")
-    if repeat:
-        repeat_interval_hours = int(os.getenv("REPEAT_INTERVAL_HOURS", "6"))
-        log.info(f"This job will repeat every {repeat_interval_hours} hours")
-        log.info(
-            "Change this value by setting the "
-            "REPEAT_INTERVAL_HOURS environment variable"
-        )
-        scheduler = apscheduler.schedulers.blocking.BlockingScheduler()
-        scheduler.add_job(
-            main_job,
-            "interval",
-            args=[repeat_interval_hours],
-            hours=repeat_interval_hours,
-        )
-        scheduler.add_job(main_job, args=[repeat_interval_hours])
-        scheduler.start()
-    else:
-        main_job()
-
-
 def handle_sigterm(_signal: int, _frame: types.FrameType) -> None:
     sys.exit()
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, handle_sigterm)
-    main()
+    sync.run_job(main_job)
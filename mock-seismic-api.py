@@ -0,0 +1,353 @@
+import csv
+import datetime
+import gzip
+import http.server
+import importlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import types
+import urllib.parse
+import uuid
+
+import notch
+
+notch.configure()
+log = logging.getLogger(__name__)
+
+# reporting jobs whose schemas decide which fields each endpoint returns
+JOBS = (
+    "get-content-usage-history",
+    "get-content-view-history",
+    "get-library-content-versions",
+    "get-library-contents",
+    "get-search-history",
+    "get-workspace-content-versions",
+    "get-workspace-contents",
+)
+
+NAMESPACE = uuid.UUID("6f1c0d8e-3f4a-4b8e-9a57-0c1d2e3f4a5b")
+
+
+def _optional_time(query: dict, name: str) -> datetime.datetime | None:
+    value = query.get(name)
+    if value is None:
+        return None
+    return _parse_time(value)
+
+
+def _parse_time(value: str) -> datetime.datetime:
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.UTC)
+    return when
+
+
+def _timestamp(when: datetime.datetime) -> str:
+    return when.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class Dataset:
+    """Deterministic synthetic records with evenly spaced modification times
+
+    Record i of every dataset is always the same, so runs are reproducible,
+    and records are ordered by modification time, so the records in a time
+    window are found by arithmetic instead of a scan."""
+
+    def __init__(
+        self,
+        name: str,
+        count: int,
+        start: datetime.datetime,
+        end: datetime.datetime,
+    ) -> None:
+        self.name = name
+        self.count = count
+        self.start = start
+        self.step = (end - start) / max(count, 1)
+
+    def index(self, when: datetime.datetime | None, default: int) -> int:
+        # The first record modified at or after when
+        if when is None:
+            return default
+        i = math.ceil((when - self.start) / self.step)
+        return min(max(i, 0), self.count)
+
+    def id(self, i: int) -> str:
+        return str(uuid.uuid5(NAMESPACE, f"{self.name}/{i}"))
+
+    def modified_at(self, i: int) -> datetime.datetime:
+        return self.start + self.step * i
+
+    def value(self, field: str, i: int) -> object:
+        # A plausible value for a field, chosen from its name
+        n = int(uuid.uuid5(NAMESPACE, f"{self.name}/{field}/{i}")) % 1000
+        if field == "id":
+            return self.id(i)
+        if field in ("modifiedAt", "lastModified"):
+            return _timestamp(self.modified_at(i))
+        if field.endswith("At"):
+            return _timestamp(self.modified_at(i) - datetime.timedelta(hours=n))
+        if field.endswith("Id"):
+            return str(uuid.uuid5(NAMESPACE, f"{field}/{n}"))
+        if field.startswith(("has", "is", "was")):
+            return n % 2 == 0
+        if field.endswith(("Count", "Index", "Pages", "Size")) or field in (
+            "resultCount",
+            "size",
+            "version",
+        ):
+            return n
+        if field.endswith("Values"):
+            return [f"value-{n % 7}", f"value-{n % 11}"]
+        return f"{field}-{n}"
+
+
+class MockSeismic:
+    """Request handling and fault injection for the mock API
+
+    latency is the mean added delay in seconds; error_rate and
+    rate_limit_rate are the fractions of API requests answered with a 503 or
+    a 429 (with Retry-After: retry_after)."""
+
+    def __init__(
+        self,
+        records: int = 10000,
+        users: int = 2000,
+        start: datetime.datetime = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC),
+        end: datetime.datetime | None = None,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: int = 1,
+        scim_max_count: int = 1000,
+        seed: int = 0,
+    ) -> None:
+        if end is None:
+            end = datetime.datetime.now(tz=datetime.UTC)
+        self.fields = {}
+        for name in JOBS:
+            job = importlib.import_module(name)
+            self.fields[job.ENDPOINT] = [f.name for f in job.SCHEMA.fields]
+        self.records = records
+        self.start = start
+        self.end = end
+        self.users = Dataset("scimUsers", users, start, end)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.scim_max_count = scim_max_count
+        self._random = random.Random(seed)  # noqa: S311
+        self._lock = threading.Lock()
+
+    def fault(self) -> tuple[int, dict] | None:
+        """Sleep for the injected latency and maybe pick an injected error"""
+        with self._lock:
+            delay = self._random.expovariate(1 / self.latency) if self.latency else 0
+            roll = self._random.random()
+        time.sleep(delay)
+        if roll < self.rate_limit_rate:
+            return 429, {"Retry-After": str(self.retry_after)}
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503, {}
+        return None
+
+    @classmethod
+    def from_env(cls) -> "MockSeismic":
+        start = _parse_time(os.getenv("MOCK_START", "2020-01-01T00:00:00"))
+        return cls(
+            records=int(os.getenv("MOCK_RECORDS", "10000")),
+            users=int(os.getenv("MOCK_USERS", "2000")),
+            start=start,
+            latency=float(os.getenv("MOCK_LATENCY_MS", "0")) / 1000,
+            error_rate=float(os.getenv("MOCK_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("MOCK_RATE_LIMIT_RATE", "0")),
+            retry_after=int(os.getenv("MOCK_RETRY_AFTER", "1")),
+            scim_max_count=int(os.getenv("MOCK_SCIM_MAX_COUNT", "1000")),
+            seed=int(os.getenv("MOCK_SEED", "0")),
+        )
+
+    def reporting(self, endpoint: str, query: dict) -> tuple[list[str], list[dict]]:
+        fields = self.fields.get(endpoint, ["id", "modifiedAt"])
+        data = Dataset(endpoint, self.records, self.start, self.end)
+        first = data.index(_optional_time(query, "modifiedAtStartTime"), 0)
+        last = data.index(_optional_time(query, "modifiedAtEndTime"), data.count)
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 1000))
+        first = min(first + offset, last)
+        last = min(first + limit, last)
+        rows = [{f: data.value(f, i) for f in fields} for i in range(first, last)]
+        return fields, rows
+
+    def scim_user(self, i: int) -> dict:
+        u = self.users
+        return {
+            "id": u.id(i),
+            "active": u.value("isActive", i),
+            "externalId": u.value("externalId", i),
+            "meta": {
+                "created": u.value("createdAt", i),
+                "lastModified": u.value("lastModified", i),
+            },
+            "name": {
+                "familyName": u.value("familyName", i),
+                "givenName": u.value("givenName", i),
+            },
+            "preferredLanguage": "en-US",
+            "timezone": "Etc/UTC",
+            "title": u.value("title", i),
+            "userName": f"user{i}@example.com",
+            "userType": u.value("userType", i),
+            "emails": [{"type": "work", "value": f"user{i}@example.com"}],
+            "roles": [{"value": "Business"}, {"value": u.value("roleLearning", i)}],
+            "urn:ietf:params:scim:schemas:extension:enterprise:2.0:User": {
+                "costCenter": u.value("costCenter", i),
+                "department": u.value("department", i),
+                "organization": u.value("organization", i),
+            },
+            "urn:ietf:params:scim:schemas:extension:seismic:2.0:User": {
+                "Country": u.value("country", i),
+                "Employee_ID": str(i),
+                "Function": u.value("function", i),
+            },
+            "urn:ietf:params:scim:schemas:extension:seismic:2.0:UserExtendedProperty": {
+                "createdBy": u.value("createdById", i),
+                "hireDate": u.value("hireAt", i),
+                "location": u.value("location", i),
+            },
+        }
+
+    def scim_users(self, query: dict) -> dict:
+        first = 0
+        match = re.fullmatch(
+            r'meta\.lastModified (?:ge|gt) "([^"]+)"', query.get("filter", "")
+        )
+        if match:
+            first = self.users.index(_parse_time(match.group(1)), 0)
+        total = self.users.count - first
+        start_index = max(int(query.get("startIndex", 1)), 1)
+        count = min(int(query.get("count", 100)), self.scim_max_count)
+        indexes = range(
+            first + start_index - 1,
+            min(first + start_index - 1 + count, self.users.count),
+        )
+        resources = [self.scim_user(i) for i in indexes]
+        return {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:ListResponse"],
+            "totalResults": total,
+            "itemsPerPage": len(resources),
+            "startIndex": start_index,
+            "Resources": resources,
+        }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock: MockSeismic
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.send_json(401, {"error": "unauthorized"})
+            return
+        fault = self.mock.fault()
+        if fault is not None:
+            status, headers = fault
+            self.send_json(status, {"error": "injected"}, headers)
+            return
+        if url.path.startswith("/reporting/v2/"):
+            endpoint = url.path.removeprefix("/reporting/v2/")
+            fields, rows = self.mock.reporting(endpoint, query)
+            if "text/csv" in self.headers.get("Accept", ""):
+                self.send_csv(fields, rows)
+            else:
+                self.send_json(200, rows)
+        elif url.path == "/scim/v2/Users":
+            self.send_json(200, self.mock.scim_users(query))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if re.fullmatch(r"/tenants/[^/]+/connect/token", self.path):
+            token = {"access_token": uuid.uuid4().hex, "expires_in": 3600}
+            self.send_json(200, token)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def log_message(self, format: str, *args: object) -> None:
+        log.debug(format % args)
+
+    def send_body(self, status: int, body: bytes, headers: dict) -> None:
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, 1)
+            headers = {**headers, "Content-Encoding": "gzip"}
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_csv(self, fields: list[str], rows: list[dict]) -> None:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {k: json.dumps(v) if isinstance(v, list) else v for k, v in row.items()}
+            )
+        self.send_body(200, buf.getvalue().encode(), {"Content-Type": "text/csv"})
+
+    def send_json(self, status: int, data: object, headers: dict | None = None) -> None:
+        body = json.dumps(data).encode()
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        self.send_body(status, body, headers)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, _request: object, client_address: tuple) -> None:
+        # clients hang up mid-response, for example after an injected error
+        log.debug(f"Lost the connection to {client_address[0]}", exc_info=True)
+
+
+def serve(
+    mock: MockSeismic, host: str = "127.0.0.1", port: int = 8080
+) -> http.server.ThreadingHTTPServer:
+    """Start the mock API in a background thread and return the server
+
+    Point SEISMIC_API_URL and SEISMIC_AUTH_URL at http://host:port. Call
+    shutdown() on the server to stop it."""
+    handler = type("MockHandler", (Handler,), {"mock": mock})
+    server = Server((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-api", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    host = os.getenv("MOCK_HOST", "127.0.0.1")
+    port = int(os.getenv("MOCK_PORT", "8080"))
+    server = serve(MockSeismic.from_env(), host, port)
+    log.info(f"Mock Seismic API listening on http://{host}:{server.server_port}")
+    signal.pause()
+
+
+def handle_sigterm(_signal: int, _frame: types.FrameType) -> None:
+    sys.exit()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    main()
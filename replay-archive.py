@@ -0,0 +1,115 @@
+import collections
+import concurrent.futures
+import importlib
+import itertools
+import logging
+import os
+import signal
+import sys
+import time
+import types
+import typing
+
+import datime
+import notch
+
+import archive
+import db
+
+notch.configure()
+log = logging.getLogger(__name__)
+
+# jobs whose pages can be archived, and so replayed
+JOBS = (
+    "get-content-usage-history",
+    "get-content-view-history",
+    "get-library-content-versions",
+    "get-library-contents",
+    "get-search-history",
+    "get-workspace-content-versions",
+    "get-workspace-contents",
+)
+
+
+def _pages(
+    a: archive.Archive, endpoint: str, workers: int
+) -> typing.Iterator[list[dict]]:
+    # Yield archived pages in the order they were fetched, reading and
+    # decoding up to `workers` files at the same time. A page that was fetched
+    # again later is only loaded at its last position.
+    entries = list(a.manifest(endpoint))
+    last = {e.get("sha256"): i for i, e in enumerate(entries)}
+    digests = [
+        e.get("sha256") for i, e in enumerate(entries) if last[e.get("sha256")] == i
+    ]
+    plural = "s"
+    if len(digests) == 1:
+        plural = ""
+    log.info(f"Replaying {len(digests)} archived {endpoint} page{plural}")
+
+    def read(digest: str) -> list[dict]:
+        return list(a.read(endpoint, digest))
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        try:
+            for digest in digests:
+                pending.append(pool.submit(read, digest))
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def replay(
+    a: archive.Archive, endpoint: str, job: types.ModuleType, workers: int
+) -> None:
+    """Load every archived page of an endpoint into its raw table
+
+    Pages are decoded in parallel but written in the order they were fetched,
+    so a record that was fetched more than once ends up as its latest copy.
+    Sync watermarks are not changed."""
+
+    batch_pages = int(os.getenv("REPLAY_BATCH_PAGES", "50"))
+    with db.connection() as cnx:
+        for batch in itertools.batched(_pages(a, endpoint, workers), batch_pages):
+            with cnx:
+                with cnx.cursor() as cur:
+                    job.batch_upsert_records(cur, list(itertools.chain(*batch)))
+
+
+def main() -> None:
+    start = time.monotonic()
+    a = archive.Archive.from_env()
+    if a is None:
+        log.critical("Set ARCHIVE_DIR to the archive to replay")
+        sys.exit(1)
+    workers = int(os.getenv("REPLAY_WORKERS", "4"))
+
+    jobs = {}
+    for name in JOBS:
+        job = importlib.import_module(name)
+        jobs[job.ENDPOINT] = job
+
+    # replay the endpoints named on the command line, or everything archived
+    endpoints = sys.argv[1:] or [e for e in a.endpoints() if e in jobs]
+    for endpoint in endpoints:
+        if endpoint not in jobs:
+            log.critical(f"There is no job for the {endpoint} endpoint")
+            sys.exit(1)
+        replay(a, endpoint, jobs[endpoint], workers)
+
+    duration = int(time.monotonic() - start)
+    log.info(f"Replay complete in {datime.pretty_duration_short(duration)}")
+
+
+def handle_sigterm(_signal: int, _frame: types.FrameType) -> None:
+    sys.exit()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    main()
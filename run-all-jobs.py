@@ -0,0 +1,94 @@
+import datetime
+import importlib
+import logging
+import os
+import signal
+import sys
+import types
+
+import apscheduler.executors.pool
+import apscheduler.schedulers.blocking
+import notch
+
+import db
+import seismic
+
+notch.configure()
+log = logging.getLogger(__name__)
+
+JOBS = (
+    "get-content-usage-history",
+    "get-content-view-history",
+    "get-library-content-versions",
+    "get-library-contents",
+    "get-search-history",
+    "get-users",
+    "get-workspace-content-versions",
+    "get-workspace-contents",
+)
+
+
+def main() -> None:
+    repeat_interval_hours = int(os.getenv("REPEAT_INTERVAL_HOURS", "6"))
+    max_concurrent_jobs = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+    log.info(
+        f"Running {len(JOBS)} jobs every {repeat_interval_hours} hours, "
+        f"at most {max_concurrent_jobs} at a time"
+    )
+
+    # every job shares one API client (and its access token) and borrows
+    # database connections from the process-wide pool, which needs one
+    # connection per job that can run at the same time, plus one per backfill
+    # worker when backfilling is on
+    per_job = 1
+    backfill_workers = int(os.getenv("BACKFILL_WORKERS", "1"))
+    if backfill_workers > 1:
+        per_job += backfill_workers
+    os.environ.setdefault("DB_POOL_MAX", str(max_concurrent_jobs * per_job))
+    pool_max = int(os.environ["DB_POOL_MAX"])
+    if backfill_workers > 1 and pool_max <= max_concurrent_jobs:
+        # every running job could hold a connection while its backfill
+        # workers wait for one that never comes back
+        log.critical(
+            f"DB_POOL_MAX ({pool_max}) must be larger than MAX_CONCURRENT_JOBS "
+            f"({max_concurrent_jobs}) when backfilling, "
+            f"{max_concurrent_jobs * per_job} lets every job backfill at once"
+        )
+        sys.exit(1)
+    c = seismic.SeismicClient.from_env()
+    db.ensure_watermarks()
+
+    executor = apscheduler.executors.pool.ThreadPoolExecutor(max_concurrent_jobs)
+    scheduler = apscheduler.schedulers.blocking.BlockingScheduler(
+        executors={"default": executor},
+        # a job that is still running when its next run is due is not started
+        # twice, missed runs are collapsed into one, and runs waiting for a free
+        # worker are not skipped
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": None},
+    )
+    # one job per endpoint whose first run is due right away, so that
+    # max_instances also keeps a slow first run from overlapping the next one
+    for name in JOBS:
+        job = importlib.import_module(name)
+        scheduler.add_job(
+            job.main_job,
+            "interval",
+            args=[c, repeat_interval_hours],
+            hours=repeat_interval_hours,
+            id=name,
+            next_run_time=datetime.datetime.now(datetime.UTC),
+        )
+    try:
+        scheduler.start()
+    finally:
+        c.close()
+        db.close_pool()
+
+
+def handle_sigterm(_signal: int, _frame: types.FrameType) -> None:
+    sys.exit()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    main()
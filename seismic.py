@@ -1,26 +1,257 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import fcntl
+import itertools
+import json
 import logging
+import os
+import random
+import threading
+import time
 import typing
 import uuid
 
 import httpx
 
+import archive
+
 log = logging.getLogger(__name__)
 
+# Responses that are worth trying again: rate limited, or a server-side failure
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
 
 def now() -> datetime.datetime:
     return datetime.datetime.now(datetime.UTC)
 
 
-class SeismicClient:
+def _iter_json_array(chunks: typing.Iterable[str]) -> typing.Iterator[typing.Any]:
+    # Decode the elements of a top-level JSON array as soon as each one is
+    # complete, without holding the whole document in memory
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Response is not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break
+            # a number cut off in the middle ("1." of "1.5") still decodes, so
+            # the element is only complete once the next , or ] has arrived
+            after = end
+            while after < len(buf) and buf[after] in " \t\r\n":
+                after += 1
+            if after == len(buf) or buf[after] not in ",]":
+                break
+            yield element
+            pos = end
+    raise ValueError("Response ended before the JSON array was closed")
+
+
+def _env_credentials() -> tuple[uuid.UUID, uuid.UUID, str, uuid.UUID]:
+    return (
+        uuid.UUID(hex=os.getenv("CLIENT_ID")),
+        uuid.UUID(hex=os.getenv("CLIENT_SECRET")),
+        os.getenv("TENANT"),
+        uuid.UUID(hex=os.getenv("USER_ID")),
+    )
+
+
+def _retry_after(resp: httpx.Response | None) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date
+    if resp is None or "Retry-After" not in resp.headers:
+        return None
+    value = resp.headers.get("Retry-After")
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - now()).total_seconds(), 0.0)
+
+
+class HttpOptions:
+    """Transport settings for the API and token sessions
+
+    HTTP/2 lets concurrent requests share one connection, and responses are
+    requested compressed with the first of `encodings` the server supports.
+    Each class of endpoint gets its own read timeout: reporting responses can
+    take minutes to produce, while auth and SCIM calls should be quick."""
+
+    def __init__(
+        self,
+        http2: bool = True,
+        encodings: typing.Sequence[str] = ("zstd", "br", "gzip"),
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 10.0,
+        auth_timeout: float = 30.0,
+        reporting_timeout: float = 300.0,
+        scim_timeout: float = 60.0,
+    ) -> None:
+        self.http2 = http2
+        self.encodings = tuple(encodings)
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.auth_timeout = auth_timeout
+        self.reporting_timeout = reporting_timeout
+        self.scim_timeout = scim_timeout
+
+    def client_options(self) -> dict:
+        # Keyword arguments for httpx.Client and httpx.AsyncClient
+        return {
+            "http2": self.http2,
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            "timeout": self.timeout("reporting"),
+            "headers": {"Accept-Encoding": ", ".join(self.encodings)},
+        }
+
+    @classmethod
+    def from_env(cls) -> "HttpOptions":
+        http2 = os.getenv("HTTP2", "true").lower() in ("1", "on", "true", "yes")
+        encodings = os.getenv("HTTP_ACCEPT_ENCODING", "zstd,br,gzip")
+        return cls(
+            http2=http2,
+            encodings=[e.strip() for e in encodings.split(",") if e.strip()],
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(
+                os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "10")
+            ),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60")),
+            connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "10")),
+            auth_timeout=float(os.getenv("AUTH_TIMEOUT_SECONDS", "30")),
+            reporting_timeout=float(os.getenv("REPORTING_TIMEOUT_SECONDS", "300")),
+            scim_timeout=float(os.getenv("SCIM_TIMEOUT_SECONDS", "60")),
+        )
+
+    def timeout(self, kind: str) -> httpx.Timeout:
+        """Timeouts for one class of endpoint: auth, reporting or scim"""
+        read = getattr(self, f"{kind}_timeout")
+        return httpx.Timeout(read, connect=self.connect_timeout)
+
+
+class RateLimiter:
+    """A thread-safe token bucket allowing `rate` requests per second
+
+    Up to `burst` requests can go out back to back after a quiet period.
+    reserve() takes a slot and returns how long the caller must wait before
+    using it, so the same limiter works for threads and asyncio tasks."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter | None":
+        rate = os.getenv("RATE_LIMIT")
+        if not rate:
+            return None
+        return cls(float(rate), int(os.getenv("RATE_LIMIT_BURST", "1")))
+
+    def reserve(self) -> float:
+        with self._lock:
+            current = time.monotonic()
+            elapsed = current - self._updated
+            self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+            self._updated = current
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RetryPolicy:
+    """How often and how long to wait before retrying a failed request
+
+    Waits for as long as the server asks in Retry-After, and otherwise backs
+    off exponentially from `backoff` seconds up to `max_backoff` seconds,
+    with full jitter so that concurrent clients do not retry in lockstep."""
+
+    def __init__(
+        self, attempts: int = 5, backoff: float = 1.0, max_backoff: float = 60.0
+    ) -> None:
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt: int, resp: httpx.Response | None = None) -> float | None:
+        """Seconds to wait before retrying, or None to give up
+
+        attempt counts from 0 for the first request."""
+        if attempt + 1 >= self.attempts:
+            return None
+        retry_after = _retry_after(resp)
+        if retry_after is not None:
+            return retry_after
+        ceiling = min(self.max_backoff, self.backoff * 2**attempt)
+        return random.uniform(0, ceiling)  # noqa: S311
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            attempts=int(os.getenv("RETRY_ATTEMPTS", "5")),
+            backoff=float(os.getenv("RETRY_BACKOFF_SECONDS", "1")),
+            max_backoff=float(os.getenv("RETRY_MAX_BACKOFF_SECONDS", "60")),
+        )
+
+
+class TokenManager:
+    """Get delegation access tokens and refresh them before they expire
+
+    Safe to share between threads, clients and event loops: refreshes are
+    serialized with a lock, and once the first token has been fetched a
+    background thread refreshes it refresh_margin seconds before it expires,
+    so requests do not wait on the token endpoint. With a cache_path, tokens
+    are also shared with other processes through a JSON file, guarded by an
+    advisory lock so that only one process requests a new token at a time."""
+
     client_id: uuid.UUID
     client_secret: uuid.UUID
     tenant: str
     user_id: uuid.UUID
 
+    auth_url: str
+    cache_path: str | None
+    http: HttpOptions
+    refresh_margin: datetime.timedelta
+
     _session: httpx.Client = None
     _token: str = None
     _token_expiration: datetime.datetime = None
+    _token_lifetime: datetime.timedelta = None
 
     def __init__(
         self,
@@ -28,106 +259,883 @@ class SeismicClient:
         client_secret: uuid.UUID,
         tenant: str,
         user_id: uuid.UUID,
+        cache_path: str | None = None,
+        refresh_margin: int = 300,
+        http: HttpOptions | None = None,
+        auth_url: str = "https://auth.seismic.com",
     ) -> None:
         self.client_id = client_id
         self.client_secret = client_secret
         self.tenant = tenant
         self.user_id = user_id
+        self.auth_url = auth_url
+        self.cache_path = cache_path
+        if http is None:
+            http = HttpOptions()
+        self.http = http
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
 
-    def _get_json(self, endpoint: str, params: dict | None = None) -> list[dict]:
-        url = f"https://api.seismic.com/reporting/v2/{endpoint}"
-        resp = self.session.get(url, params=params)
+    @property
+    def _cache_key(self) -> str:
+        return f"{self.tenant}/{self.client_id}/{self.user_id}"
+
+    @contextlib.contextmanager
+    def _cache_lock(self) -> typing.Iterator[None]:
+        with open(f"{self.cache_path}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _margin(self) -> datetime.timedelta:
+        # Refresh refresh_margin before the token expires, but no sooner than
+        # halfway through its lifetime, or a token that lives for less than
+        # the margin would be refreshed again as soon as it arrived
+        if self._token_lifetime is None:
+            return self.refresh_margin
+        return min(self.refresh_margin, self._token_lifetime / 2)
+
+    def _read_cache(self) -> None:
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f).get(self._cache_key)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if cached:
+            self._token = cached.get("access_token")
+            self._token_expiration = datetime.datetime.fromisoformat(
+                cached.get("expires_at")
+            )
+            self._token_lifetime = None
+            if cached.get("lifetime") is not None:
+                self._token_lifetime = datetime.timedelta(seconds=cached["lifetime"])
+
+    def _refresh(self) -> None:
+        # Callers hold self._lock
+        if self.cache_path is None:
+            self._request_token()
+            return
+        with self._cache_lock():
+            # another process may have refreshed the token already
+            self._read_cache()
+            if not self._valid(self._margin()):
+                self._request_token()
+                self._write_cache()
+
+    def _request_token(self) -> None:
+        log.debug("Getting a new access token")
+        url = f"{self.auth_url}/tenants/{self.tenant}/connect/token"
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "delegation",
+            "scope": " ".join(
+                (
+                    "seismic.reporting",
+                    "seismic.library.view",
+                    "seismic.user.manage",
+                    "seismic.user.view",
+                )
+            ),
+            "user_id": self.user_id,
+        }
+        if self._session is None:
+            self._session = httpx.Client(**self.http.client_options())
+        resp = self._session.post(url, data=data, timeout=self.http.timeout("auth"))
         resp.raise_for_status()
-        return resp.json()
+        j = resp.json()
+        self._token = j.get("access_token")
+        expires_in = j.get("expires_in")
+        self._token_lifetime = datetime.timedelta(seconds=max(expires_in - 10, 0))
+        self._token_expiration = now() + self._token_lifetime
+
+    def _run_refresher(self) -> None:
+        delay = 0.0
+        while not self._stop.wait(delay):
+            with self._lock:
+                try:
+                    if not self._valid(self._margin()):
+                        self._refresh()
+                except httpx.HTTPError as e:
+                    log.warning(f"Could not refresh the access token: {e}")
+                    delay = 30.0
+                    continue
+                until = self._token_expiration - self._margin() - now()
+            delay = max(until.total_seconds(), 1.0)
+
+    def _valid(self, margin: datetime.timedelta = datetime.timedelta()) -> bool:
+        return (
+            self._token is not None
+            and self._token_expiration is not None
+            and self._token_expiration - margin > now()
+        )
+
+    def _write_cache(self) -> None:
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cache = {}
+        cache[self._cache_key] = {
+            "access_token": self._token,
+            "expires_at": self._token_expiration.isoformat(),
+            "lifetime": self._token_lifetime.total_seconds(),
+        }
+        tmp = f"{self.cache_path}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, self.cache_path)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    @classmethod
+    def from_env(cls) -> "TokenManager":
+        return cls(
+            *_env_credentials(),
+            cache_path=os.getenv("TOKEN_CACHE") or None,
+            refresh_margin=int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300")),
+            http=HttpOptions.from_env(),
+            auth_url=os.getenv("SEISMIC_AUTH_URL", "https://auth.seismic.com"),
+        )
+
+    def get(self) -> str:
+        """Return a valid access token, fetching one first if necessary"""
+        if not self._valid():
+            with self._lock:
+                if not self._valid():
+                    self._refresh()
+                if self._refresher is None:
+                    self._refresher = threading.Thread(
+                        target=self._run_refresher, name="token-refresh", daemon=True
+                    )
+                    self._refresher.start()
+        return self._token
+
+    def peek(self) -> str | None:
+        """Return the current access token if it is valid, without blocking"""
+        if self._valid():
+            return self._token
+        return None
+
+
+class _BaseClient:
+    # Credentials, tokens, transport settings, retries and rate limiting
+    # shared by the sync and async clients
+
+    client_id: uuid.UUID
+    client_secret: uuid.UUID
+    tenant: str
+    user_id: uuid.UUID
+
+    api_url: str
+    http: HttpOptions
+    rate_limiter: RateLimiter | None
+    retry: RetryPolicy
+    tokens: TokenManager
+
+    def __init__(
+        self,
+        client_id: uuid.UUID,
+        client_secret: uuid.UUID,
+        tenant: str,
+        user_id: uuid.UUID,
+        tokens: TokenManager | None = None,
+        retry: RetryPolicy | None = None,
+        rate_limiter: RateLimiter | None = None,
+        http: HttpOptions | None = None,
+        api_url: str = "https://api.seismic.com",
+    ) -> None:
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tenant = tenant
+        self.user_id = user_id
+        self.api_url = api_url
+        if http is None:
+            http = HttpOptions()
+        self.http = http
+        if tokens is None:
+            tokens = TokenManager(client_id, client_secret, tenant, user_id, http=http)
+        self.tokens = tokens
+        if retry is None:
+            retry = RetryPolicy()
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+
+    def _next_scim_pages(self, first: dict) -> range | None:
+        # startIndex of every SCIM page after the first one, or None if the
+        # first page does not say how many users there are. The server may
+        # return fewer users per page than were asked for, so the step is
+        # taken from the first page.
+        per_page = first.get("itemsPerPage")
+        total = first.get("totalResults")
+        if not per_page or total is None:
+            return None
+        return range(1 + per_page, total + 1, per_page)
+
+    def _rate_limit_delay(self) -> float:
+        if self.rate_limiter is None:
+            return 0.0
+        return self.rate_limiter.reserve()
+
+    def _retry_delay(
+        self,
+        attempt: int,
+        url: str,
+        resp: httpx.Response | None = None,
+        error: httpx.TransportError | None = None,
+    ) -> float | None:
+        delay = self.retry.delay(attempt, resp)
+        if delay is not None:
+            reason = error or f"HTTP {resp.status_code}"
+            log.warning(f"Request to {url} failed ({reason}), retrying in {delay:.1f}s")
+        return delay
+
+
+class SeismicClient(_BaseClient):
+    archive: archive.Archive | None
+    csv_mode: bool
+    page_size: int
+    scim_page_size: int
+    scim_workers: int
+    stream: bool
+
+    _session: httpx.Client = None
+
+    def __init__(
+        self,
+        client_id: uuid.UUID,
+        client_secret: uuid.UUID,
+        tenant: str,
+        user_id: uuid.UUID,
+        page_size: int = 1000,
+        stream: bool = False,
+        csv_mode: bool = False,
+        scim_page_size: int = 100,
+        scim_workers: int = 1,
+        archive: archive.Archive | None = None,
+        tokens: TokenManager | None = None,
+        retry: RetryPolicy | None = None,
+        rate_limiter: RateLimiter | None = None,
+        http: HttpOptions | None = None,
+        api_url: str = "https://api.seismic.com",
+    ) -> None:
+        super().__init__(
+            client_id,
+            client_secret,
+            tenant,
+            user_id,
+            tokens,
+            retry,
+            rate_limiter,
+            http,
+            api_url,
+        )
+        self.page_size = page_size
+        self.stream = stream
+        self.csv_mode = csv_mode
+        self.scim_page_size = scim_page_size
+        self.scim_workers = scim_workers
+        self.archive = archive
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "SeismicClient":
+        return self
+
+    def __exit__(self, *_args: object) -> None:
+        self.close()
+
+    @classmethod
+    def from_env(cls) -> "SeismicClient":
+        return cls(
+            *_env_credentials(),
+            tokens=TokenManager.from_env(),
+            retry=RetryPolicy.from_env(),
+            rate_limiter=RateLimiter.from_env(),
+            http=HttpOptions.from_env(),
+            api_url=os.getenv("SEISMIC_API_URL", "https://api.seismic.com"),
+            page_size=int(os.getenv("PAGE_SIZE", "1000")),
+            stream=os.getenv("STREAM_JSON", "false").lower()
+            in ("1", "on", "true", "yes"),
+            csv_mode=os.getenv("CSV_MODE", "false").lower()
+            in ("1", "on", "true", "yes"),
+            scim_page_size=int(os.getenv("SCIM_PAGE_SIZE", "100")),
+            scim_workers=int(os.getenv("SCIM_WORKERS", "1")),
+            archive=archive.Archive.from_env(),
+        )
+
+    def _authorization(self) -> str:
+        return f"Bearer {self.tokens.get()}"
+
+    def _get(
+        self,
+        url: str,
+        params: dict | None = None,
+        headers: dict | None = None,
+        stream: bool = False,
+        timeout: httpx.Timeout | None = None,
+    ) -> httpx.Response:
+        # Send a GET request, retrying rate-limited and failed requests. With
+        # stream=True the caller must close the response. The timeout defaults
+        # to the one for reporting endpoints. The token goes on each request
+        # rather than on the shared session, which other threads are using.
+        if timeout is None:
+            timeout = self.http.timeout("reporting")
+        attempt = 0
+        while True:
+            time.sleep(self._rate_limit_delay())
+            session = self.session
+            request = session.build_request(
+                "GET",
+                url,
+                params=params,
+                headers={**(headers or {}), "Authorization": self._authorization()},
+                timeout=timeout,
+            )
+            try:
+                resp = session.send(request, stream=stream)
+            except httpx.TransportError as e:
+                delay = self._retry_delay(attempt, url, error=e)
+                if delay is None:
+                    raise
+            else:
+                delay = None
+                if resp.status_code in RETRY_STATUSES:
+                    delay = self._retry_delay(attempt, url, resp=resp)
+                if delay is None:
+                    if resp.is_error:
+                        resp.close()
+                    resp.raise_for_status()
+                    return resp
+                resp.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _get_json(self, endpoint: str, params: dict | None = None) -> list[dict]:
+        url = f"{self.api_url}/reporting/v2/{endpoint}"
+        return self._get(url, params).json()
+
+    def _get_pages(
+        self, endpoint: str, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        for page in itertools.batched(
+            self._get_records(endpoint, params), self.page_size
+        ):
+            yield list(page)
+
+    def _get_records(
+        self, endpoint: str, params: dict | None = None
+    ) -> typing.Iterator[dict]:
+        # Page through a reporting endpoint with limit/offset so that only one
+        # page of records is held in memory at a time
+        params = dict(params or {})
+        offset = 0
+        more = True
+        while more:
+            params.update(
+                {
+                    "limit": self.page_size,
+                    "offset": offset,
+                }
+            )
+            if self.stream:
+                records = self._stream_json(endpoint, params)
+            else:
+                records = self._get_json(endpoint, params)
+            if self.archive is not None:
+                records = list(records)
+                if records:
+                    self.archive.write(endpoint, params, records)
+            count = 0
+            for record in records:
+                count += 1
+                yield record
+            offset += count
+            if count < self.page_size:
+                more = False
+
+    def _get_scim_page(self, start_index: int, scim_filter: str | None = None) -> dict:
+        url = f"{self.api_url}/scim/v2/Users"
+        params = {
+            "count": self.scim_page_size,
+            "startIndex": start_index,
+        }
+        if scim_filter is not None:
+            params["filter"] = scim_filter
+        return self._get(url, params, timeout=self.http.timeout("scim")).json()
+
+    def _load_csv(
+        self,
+        endpoint: str,
+        load: typing.Callable[[typing.Iterator[str]], int],
+        params: dict | None = None,
+    ) -> int:
+        # Page through a reporting endpoint as text/csv with limit/offset.
+        # load(chunks) stores the body of one page and returns how many rows
+        # it held; a short page is the last one. Returns the total row count.
+        params = dict(params or {})
+        offset = 0
+        while True:
+            params.update(
+                {
+                    "limit": self.page_size,
+                    "offset": offset,
+                }
+            )
+            count = load(self._stream_csv(endpoint, params))
+            offset += count
+            if count < self.page_size:
+                return offset
+
+    def _stream_csv(
+        self, endpoint: str, params: dict | None = None
+    ) -> typing.Iterator[str]:
+        # Yield the raw text/csv body of a reporting endpoint as it arrives,
+        # for loading with COPY without decoding each row in Python
+        url = f"{self.api_url}/reporting/v2/{endpoint}"
+        headers = {"Accept": "text/csv"}
+        resp = self._get(url, params, headers, stream=True)
+        try:
+            yield from resp.iter_text()
+        finally:
+            resp.close()
+
+    def _stream_json(
+        self, endpoint: str, params: dict | None = None
+    ) -> typing.Iterator[dict]:
+        url = f"{self.api_url}/reporting/v2/{endpoint}"
+        resp = self._get(url, params, stream=True)
+        try:
+            yield from _iter_json_array(resp.iter_text())
+        finally:
+            resp.close()
+
+    def close(self) -> None:
+        """Stop the token refresher and close the HTTP sessions"""
+        self.tokens.close()
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
     def content_usage_history(self, params: dict | None = None) -> list[dict]:
         return self._get_json("contentUsageHistory", params)
 
+    def content_usage_history_csv(
+        self,
+        load: typing.Callable[[typing.Iterator[str]], int],
+        params: dict | None = None,
+    ) -> int:
+        return self._load_csv("contentUsageHistory", load, params)
+
+    def content_usage_history_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("contentUsageHistory", params)
+
     def content_view_history(self, params: dict | None = None) -> list[dict]:
         return self._get_json("contentViewHistory", params)
 
+    def content_view_history_csv(
+        self,
+        load: typing.Callable[[typing.Iterator[str]], int],
+        params: dict | None = None,
+    ) -> int:
+        return self._load_csv("contentViewHistory", load, params)
+
+    def content_view_history_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("contentViewHistory", params)
+
     def library_content_versions(self, params: dict | None = None) -> list[dict]:
         return self._get_json("libraryContentVersions", params)
 
+    def library_content_versions_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("libraryContentVersions", params)
+
     def library_contents(self, params: dict | None = None) -> list[dict]:
         return self._get_json("libraryContents", params)
 
-    def scim_users(self) -> typing.Iterator[dict]:
-        results_per_page = 100
-        url = "https://api.seismic.com/scim/v2/Users"
-        params = {
-            "count": results_per_page,
-            "startIndex": 1,
-        }
+    def library_contents_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("libraryContents", params)
+
+    def scim_users(self, scim_filter: str | None = None) -> typing.Iterator[dict]:
+        """Yield every user from the SCIM API, in order
+
+        scim_filter is a SCIM filter expression, for example
+        'meta.lastModified ge "2024-01-01T00:00:00Z"'. After the first page,
+        which says how many users there are, up to scim_workers pages are
+        fetched at the same time."""
+        data = self._get_scim_page(1, scim_filter)
+        yield from data.get("Resources")
+        starts = self._next_scim_pages(data)
+        if starts is None:
+            # no totalResults, so walk the pages until a short one comes back
+            start_index = 1
+            per_page = data.get("itemsPerPage")
+            while per_page and per_page >= self.scim_page_size:
+                start_index += per_page
+                data = self._get_scim_page(start_index, scim_filter)
+                yield from data.get("Resources")
+                per_page = data.get("itemsPerPage")
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.scim_workers) as pool:
+            pending = collections.deque()
+            try:
+                for start_index in starts:
+                    future = pool.submit(self._get_scim_page, start_index, scim_filter)
+                    pending.append(future)
+                    if len(pending) >= self.scim_workers:
+                        yield from pending.popleft().result().get("Resources")
+                while pending:
+                    yield from pending.popleft().result().get("Resources")
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def search_history(self, params: dict | None = None) -> list[dict]:
+        return self._get_json("searchHistory", params)
+
+    def search_history_csv(
+        self,
+        load: typing.Callable[[typing.Iterator[str]], int],
+        params: dict | None = None,
+    ) -> int:
+        return self._load_csv("searchHistory", load, params)
+
+    def search_history_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("searchHistory", params)
+
+    @property
+    def session(self) -> httpx.Client:
+        with self._lock:
+            if self._session is None:
+                log.debug("Setting up a new session")
+                self._session = httpx.Client(**self.http.client_options())
+                self._session.headers.update(
+                    {
+                        "Accept": "application/json",
+                    }
+                )
+            return self._session
+
+    def user_property_assignments(self, params: dict | None = None) -> list[dict]:
+        return self._get_json("userPropertyAssignments", params)
+
+    def user_property_assignments_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("userPropertyAssignments", params)
+
+    def users(self, params: dict | None = None) -> list[dict]:
+        return self._get_json("users", params)
+
+    def users_pages(self, params: dict | None = None) -> typing.Iterator[list[dict]]:
+        return self._get_pages("users", params)
+
+    def workspace_content_versions(self, params: dict | None = None) -> list[dict]:
+        return self._get_json("workspaceContentVersions", params)
+
+    def workspace_content_versions_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("workspaceContentVersions", params)
+
+    def workspace_contents(self, params: dict | None = None) -> list[dict]:
+        return self._get_json("workspaceContents", params)
+
+    def workspace_contents_pages(
+        self, params: dict | None = None
+    ) -> typing.Iterator[list[dict]]:
+        return self._get_pages("workspaceContents", params)
+
+
+class AsyncSeismicClient(_BaseClient):
+    """An asyncio counterpart to SeismicClient
+
+    At most `concurrency` requests are in flight at once, no matter how many
+    tasks share the client. Use it as an async context manager, or call
+    aclose() when done."""
+
+    concurrency: int
+    page_size: int
+    scim_page_size: int
+
+    _session: httpx.AsyncClient = None
+
+    def __init__(
+        self,
+        client_id: uuid.UUID,
+        client_secret: uuid.UUID,
+        tenant: str,
+        user_id: uuid.UUID,
+        page_size: int = 1000,
+        concurrency: int = 4,
+        scim_page_size: int = 100,
+        tokens: TokenManager | None = None,
+        retry: RetryPolicy | None = None,
+        rate_limiter: RateLimiter | None = None,
+        http: HttpOptions | None = None,
+        api_url: str = "https://api.seismic.com",
+    ) -> None:
+        super().__init__(
+            client_id,
+            client_secret,
+            tenant,
+            user_id,
+            tokens,
+            retry,
+            rate_limiter,
+            http,
+            api_url,
+        )
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.scim_page_size = scim_page_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self) -> "AsyncSeismicClient":
+        return self
+
+    async def __aexit__(self, *_args: object) -> None:
+        await self.aclose()
+
+    @classmethod
+    def from_env(cls) -> "AsyncSeismicClient":
+        return cls(
+            *_env_credentials(),
+            tokens=TokenManager.from_env(),
+            retry=RetryPolicy.from_env(),
+            rate_limiter=RateLimiter.from_env(),
+            http=HttpOptions.from_env(),
+            api_url=os.getenv("SEISMIC_API_URL", "https://api.seismic.com"),
+            page_size=int(os.getenv("PAGE_SIZE", "1000")),
+            concurrency=int(os.getenv("CONCURRENCY", "4")),
+            scim_page_size=int(os.getenv("SCIM_PAGE_SIZE", "100")),
+        )
+
+    async def _authorization(self) -> str:
+        # fetching a token blocks, so do it off the event loop; once the token
+        # manager is refreshing in the background this is rarely needed
+        token = self.tokens.peek()
+        if token is None:
+            token = await asyncio.to_thread(self.tokens.get)
+        return f"Bearer {token}"
+
+    async def _get(
+        self,
+        url: str,
+        params: dict | None = None,
+        timeout: httpx.Timeout | None = None,
+    ) -> httpx.Response:
+        # Send a GET request, retrying rate-limited and failed requests. The
+        # concurrency slot is only held while a request is in flight, not
+        # while waiting to retry. The timeout defaults to the one for
+        # reporting endpoints.
+        if timeout is None:
+            timeout = self.http.timeout("reporting")
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._rate_limit_delay())
+            async with self._semaphore:
+                session = self.session
+                headers = {"Authorization": await self._authorization()}
+                try:
+                    resp = await session.get(
+                        url, params=params, headers=headers, timeout=timeout
+                    )
+                except httpx.TransportError as e:
+                    resp = None
+                    delay = self._retry_delay(attempt, url, error=e)
+                    if delay is None:
+                        raise
+            if resp is not None:
+                delay = None
+                if resp.status_code in RETRY_STATUSES:
+                    delay = self._retry_delay(attempt, url, resp=resp)
+                if delay is None:
+                    resp.raise_for_status()
+                    return resp
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get_json(self, endpoint: str, params: dict | None = None) -> list[dict]:
+        url = f"{self.api_url}/reporting/v2/{endpoint}"
+        resp = await self._get(url, params)
+        return resp.json()
+
+    async def _get_pages(
+        self, endpoint: str, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        params = dict(params or {})
+        offset = 0
         more = True
         while more:
-            resp = self.session.get(url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            yield from data.get("Resources")
             params.update(
                 {
-                    "startIndex": params.get("startIndex") + results_per_page,
+                    "limit": self.page_size,
+                    "offset": offset,
                 }
             )
-            if data.get("itemsPerPage") < results_per_page:
+            page = await self._get_json(endpoint, params)
+            if page:
+                yield page
+            offset += len(page)
+            if len(page) < self.page_size:
                 more = False
 
-    def search_history(self, params: dict | None = None) -> list[dict]:
-        return self._get_json("searchHistory", params)
+    async def _get_scim_page(
+        self, start_index: int, scim_filter: str | None = None
+    ) -> dict:
+        url = f"{self.api_url}/scim/v2/Users"
+        params = {
+            "count": self.scim_page_size,
+            "startIndex": start_index,
+        }
+        if scim_filter is not None:
+            params["filter"] = scim_filter
+        resp = await self._get(url, params, self.http.timeout("scim"))
+        return resp.json()
+
+    async def aclose(self) -> None:
+        self.tokens.close()
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    async def content_usage_history(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("contentUsageHistory", params)
+
+    def content_usage_history_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("contentUsageHistory", params)
+
+    async def content_view_history(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("contentViewHistory", params)
+
+    def content_view_history_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("contentViewHistory", params)
+
+    async def library_content_versions(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("libraryContentVersions", params)
+
+    def library_content_versions_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("libraryContentVersions", params)
+
+    async def library_contents(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("libraryContents", params)
+
+    def library_contents_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("libraryContents", params)
+
+    async def scim_users(
+        self, scim_filter: str | None = None
+    ) -> typing.AsyncIterator[dict]:
+        # Like SeismicClient.scim_users, with up to `concurrency` pages in flight
+        data = await self._get_scim_page(1, scim_filter)
+        for user in data.get("Resources"):
+            yield user
+        starts = self._next_scim_pages(data)
+        if starts is None:
+            start_index = 1
+            per_page = data.get("itemsPerPage")
+            while per_page and per_page >= self.scim_page_size:
+                start_index += per_page
+                data = await self._get_scim_page(start_index, scim_filter)
+                for user in data.get("Resources"):
+                    yield user
+                per_page = data.get("itemsPerPage")
+            return
+        pending = collections.deque()
+        try:
+            for start_index in starts:
+                page = self._get_scim_page(start_index, scim_filter)
+                pending.append(asyncio.create_task(page))
+                if len(pending) >= self.concurrency:
+                    for user in (await pending.popleft()).get("Resources"):
+                        yield user
+            while pending:
+                for user in (await pending.popleft()).get("Resources"):
+                    yield user
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def search_history(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("searchHistory", params)
+
+    def search_history_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("searchHistory", params)
 
     @property
-    def session(self) -> httpx.Client:
+    def session(self) -> httpx.AsyncClient:
         if self._session is None:
-            log.debug("Setting up a new session")
-            self._session = httpx.Client()
+            log.debug("Setting up a new async session")
+            self._session = httpx.AsyncClient(**self.http.client_options())
             self._session.headers.update(
                 {
                     "Accept": "application/json",
                 }
             )
-        if (
-            self._token is None
-            or self._token_expiration is None
-            or self._token_expiration < now()
-        ):
-            log.debug("Getting a new access token")
-            url = f"https://auth.seismic.com/tenants/{self.tenant}/connect/token"
-            data = {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "grant_type": "delegation",
-                "scope": " ".join(
-                    (
-                        "seismic.reporting",
-                        "seismic.library.view",
-                        "seismic.user.manage",
-                        "seismic.user.view",
-                    )
-                ),
-                "user_id": self.user_id,
-            }
-            resp = self._session.post(url, data=data)
-            resp.raise_for_status()
-            j = resp.json()
-            self._token = j.get("access_token")
-            expires_in = j.get("expires_in")
-            self._token_expiration = now() + datetime.timedelta(seconds=expires_in - 10)
-            self._session.headers.update(
-                {
-                    "Authorization": f"Bearer {self._token}",
-                }
-            )
         return self._session
 
-    def user_property_assignments(self, params: dict | None = None) -> list[dict]:
-        return self._get_json("userPropertyAssignments", params)
+    async def user_property_assignments(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("userPropertyAssignments", params)
 
-    def users(self, params: dict | None = None) -> list[dict]:
-        return self._get_json("users", params)
+    def user_property_assignments_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("userPropertyAssignments", params)
 
-    def workspace_content_versions(self, params: dict | None = None) -> list[dict]:
-        return self._get_json("workspaceContentVersions", params)
+    async def users(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("users", params)
 
-    def workspace_contents(self, params: dict | None = None) -> list[dict]:
-        return self._get_json("workspaceContents", params)
+    def users_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("users", params)
+
+    async def workspace_content_versions(
+        self, params: dict | None = None
+    ) -> list[dict]:
+        return await self._get_json("workspaceContentVersions", params)
+
+    def workspace_content_versions_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("workspaceContentVersions", params)
+
+    async def workspace_contents(self, params: dict | None = None) -> list[dict]:
+        return await self._get_json("workspaceContents", params)
+
+    def workspace_contents_pages(
+        self, params: dict | None = None
+    ) -> typing.AsyncIterator[list[dict]]:
+        return self._get_pages("workspaceContents", params)
@@ -0,0 +1,398 @@
+import concurrent.futures
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+import typing
+
+import apscheduler.schedulers.blocking
+import psycopg2.extensions
+
+import db
+import seismic
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+# backfill shards are aligned to multiples of the shard size from here
+_SHARD_ORIGIN = datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC)
+
+
+class _WindowEnd(typing.NamedTuple):
+    # Yielded after the last page of a window; watermark is None for the last
+    # window before now
+    watermark: datetime.datetime | None
+
+
+class WindowSizer:
+    """Choose the size of each time window from how the previous one went
+
+    The window halves when a window returns more than target_rows records or
+    takes longer than target_seconds to fetch, and doubles when a window
+    returns less than a quarter of target_rows in less than a quarter of
+    target_seconds. The size always stays between minimum and maximum, except
+    for a last window that is cut short where the history ends."""
+
+    def __init__(
+        self,
+        initial: datetime.timedelta,
+        target_rows: int | None = None,
+        target_seconds: float | None = None,
+        minimum: datetime.timedelta = datetime.timedelta(minutes=15),
+        maximum: datetime.timedelta = datetime.timedelta(days=365),
+    ) -> None:
+        if target_rows is None:
+            target_rows = int(os.getenv("WINDOW_TARGET_ROWS", "50000"))
+        if target_seconds is None:
+            target_seconds = float(os.getenv("WINDOW_TARGET_SECONDS", "60"))
+        self.size = initial
+        self.target_rows = target_rows
+        self.target_seconds = target_seconds
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, rows: int, seconds: float) -> None:
+        if rows > self.target_rows or seconds > self.target_seconds:
+            self.size = max(self.size / 2, self.minimum)
+        elif rows < self.target_rows / 4 and seconds < self.target_seconds / 4:
+            self.size = min(self.size * 2, self.maximum)
+
+
+def _windows(
+    start: datetime.datetime,
+    sizer: WindowSizer,
+    description: str,
+    stop: datetime.datetime | None = None,
+) -> typing.Iterator[tuple[datetime.datetime | None, dict]]:
+    # Yield (watermark, request params) for consecutive windows from start
+    # until stop, or until now, asking the sizer for the size of each window
+    # as it goes. The size never runs past the end, so a window that reaches
+    # it does not leave the sizer far larger than the history it covered.
+    # The watermark is the window end, except for the last window before now:
+    # records modified just before now can still show up later, so that
+    # window has no watermark and the caller moves the watermark to the
+    # newest record it loaded instead.
+    until = stop or datetime.datetime.now(tz=datetime.UTC)
+    while start < until:
+        sizer.size = min(sizer.size, until - start)
+        end = start + sizer.size
+        start_s = start.strftime("%Y-%m-%dT%H:%M:%S")
+        end_s = end.strftime("%Y-%m-%dT%H:%M:%S")
+        log.info(
+            f"Looking for {description} modified between {start_s} and {end_s} "
+            f"(window size {sizer.size})"
+        )
+        params = {
+            "modifiedAtStartTime": start_s,
+            "modifiedAtEndTime": end_s,
+        }
+        if stop is None and end == until:
+            yield None, params
+        else:
+            yield end, params
+        start = end
+
+
+def _shard_key(endpoint: str, shard_end: datetime.datetime) -> str:
+    # The watermark that checkpoints progress through one backfill shard
+    return f"{endpoint}:backfill:{shard_end.isoformat()}"
+
+
+def _shards(
+    start: datetime.datetime, stop: datetime.datetime, size: datetime.timedelta
+) -> list[tuple[datetime.datetime, datetime.datetime]]:
+    # Complete shards between start and stop. Shard ends sit on a fixed grid,
+    # so a backfill that resumes from a later start finds the same shards and
+    # their checkpoints.
+    shards = []
+    shard_end = _SHARD_ORIGIN + ((start - _SHARD_ORIGIN) // size + 1) * size
+    while shard_end <= stop:
+        shards.append((start, shard_end))
+        start = shard_end
+        shard_end += size
+    return shards
+
+
+def backfill(
+    endpoint: str,
+    table: str,
+    start: datetime.datetime,
+    step: datetime.timedelta,
+    description: str,
+    fetch_pages: typing.Callable[[dict], typing.Iterable[list[dict]]],
+    upsert: typing.Callable[[psycopg2.extensions.cursor, list[dict]], object],
+    shard_size: datetime.timedelta | None = None,
+    workers: int | None = None,
+) -> datetime.datetime:
+    """Load history in parallel shards and return where to carry on from
+
+    The time from start is split into shards of shard_size
+    (BACKFILL_SHARD_DAYS, default 90 days), and up to `workers`
+    (BACKFILL_WORKERS, default 1, which turns backfilling off) shards are
+    loaded at the same time, each on its own pooled connection with
+    run_windows. Shards can finish in any order; each one checkpoints its
+    progress in its own watermark, so an interrupted backfill resumes where
+    every shard left off. The watermark for endpoint only advances over the
+    shards that form a contiguous committed prefix from start."""
+
+    if workers is None:
+        workers = int(os.getenv("BACKFILL_WORKERS", "1"))
+    if shard_size is None:
+        shard_size = datetime.timedelta(
+            days=float(os.getenv("BACKFILL_SHARD_DAYS", "90"))
+        )
+    shards = _shards(start, datetime.datetime.now(tz=datetime.UTC), shard_size)
+    if workers < 2 or len(shards) < 2:
+        return start
+    # every worker needs a connection, and the caller is holding one
+    available = db.get_pool().maxconn - 1
+    if workers > available:
+        log.warning(
+            f"Only {available} of {workers} backfill workers fit in the "
+            "connection pool, raise DB_POOL_MAX to use more"
+        )
+        workers = available
+        # a lone worker would load the shards one after another anyway
+        if workers < 2:
+            return start
+    log.info(
+        f"Backfilling {description} in {len(shards)} shards of {shard_size} "
+        f"with {workers} workers"
+    )
+
+    done = [False] * len(shards)
+    lock = threading.Lock()
+    prefix = 0
+
+    def load_shard(i: int) -> None:
+        nonlocal prefix
+        shard_start, shard_end = shards[i]
+        key = _shard_key(endpoint, shard_end)
+        with db.connection() as cnx:
+            with cnx:
+                with cnx.cursor() as cur:
+                    resume = db.get_watermark(cur, key) or shard_start
+            if resume < shard_end:
+                run_windows(
+                    cnx,
+                    key,
+                    table,
+                    max(resume, shard_start),
+                    step,
+                    description,
+                    fetch_pages,
+                    upsert,
+                    stop=shard_end,
+                )
+            with lock:
+                done[i] = True
+                while prefix < len(done) and done[prefix]:
+                    prefix += 1
+                committed = shards[:prefix]
+            if committed:
+                with cnx:
+                    with cnx.cursor() as cur:
+                        db.set_watermark(cur, endpoint, committed[-1][1])
+                        for _, committed_end in committed:
+                            db.delete_watermark(
+                                cur, _shard_key(endpoint, committed_end)
+                            )
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(load_shard, i) for i in range(len(shards))]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return shards[-1][1]
+
+
+def load_windows(
+    cnx: psycopg2.extensions.connection,
+    endpoint: str,
+    table: str,
+    start: datetime.datetime,
+    step: datetime.timedelta,
+    description: str,
+    fetch_csv: typing.Callable[
+        [typing.Callable[[typing.Iterator[str]], int], dict], int
+    ],
+) -> None:
+    """Load consecutive time windows of CSV one after another
+
+    fetch_csv(load, params) is one of the client's *_csv methods; every page
+    it fetches is streamed straight into table with COPY, and each window is
+    committed in its own transaction. step is the initial window size. The
+    watermark for endpoint advances in the same transaction as each window,
+    to the window end, or for the last window before now to the newest
+    record it loaded."""
+
+    sizer = WindowSizer(step)
+    for watermark, params in _windows(start, sizer, description):
+        started = time.monotonic()
+        with cnx:
+            with cnx.cursor() as cur:
+
+                def load(chunks: typing.Iterator[str]) -> int:
+                    count = db.upsert_csv(cur, table, chunks)
+                    if count:
+                        db.set_watermark_from_stage(cur, endpoint, table)
+                    return count
+
+                rows = fetch_csv(load, params)
+                if watermark is not None:
+                    db.set_watermark(cur, endpoint, watermark)
+        sizer.update(rows, time.monotonic() - started)
+
+
+def prefetch(
+    items: typing.Iterable[typing.Any], size: int | None = None
+) -> typing.Iterator[typing.Any]:
+    """Iterate over items in a background thread, keeping up to `size` ahead
+
+    Lets a slow consumer, such as a database writer, overlap with a slow
+    producer, such as paging through an API. size defaults to PREFETCH_PAGES.
+    Exceptions from the producer are raised in the consumer."""
+
+    if size is None:
+        size = int(os.getenv("PREFETCH_PAGES", "4"))
+    q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item: object) -> None:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+            except queue.Full:
+                continue
+            return
+
+    def produce() -> None:
+        try:
+            for item in items:
+                put(item)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(_DONE)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def run_job(
+    main_job: typing.Callable[[seismic.SeismicClient, int | None], None],
+) -> None:
+    """Run a job's main_job once, or every REPEAT_INTERVAL_HOURS with REPEAT on
+
+    Every run gets the same API client, so runs share its sessions and token
+    refresher; the client is closed when the job stops."""
+
+    db.ensure_watermarks()
+    with seismic.SeismicClient.from_env() as c:
+        repeat = os.getenv("REPEAT", "false").lower() in ("1", "on", "true", "yes")
+        if repeat:
+            repeat_interval_hours = int(os.getenv("REPEAT_INTERVAL_HOURS", "6"))
+            log.info(f"This job will repeat every {repeat_interval_hours} hours")
+            log.info(
+                "Change this value by setting the "
+                "REPEAT_INTERVAL_HOURS environment variable"
+            )
+            scheduler = apscheduler.schedulers.blocking.BlockingScheduler()
+            scheduler.add_job(
+                main_job,
+                "interval",
+                args=[c, repeat_interval_hours],
+                hours=repeat_interval_hours,
+            )
+            scheduler.add_job(main_job, args=[c, repeat_interval_hours])
+            scheduler.start()
+        else:
+            main_job(c)
+
+
+def run_windows(
+    cnx: psycopg2.extensions.connection,
+    endpoint: str,
+    table: str,
+    start: datetime.datetime,
+    step: datetime.timedelta,
+    description: str,
+    fetch_pages: typing.Callable[[dict], typing.Iterable[list[dict]]],
+    upsert: typing.Callable[[psycopg2.extensions.cursor, list[dict]], object],
+    prefetch_pages: int | None = None,
+    stop: datetime.datetime | None = None,
+) -> None:
+    """Fetch and store consecutive time windows with fetching and writing overlapped
+
+    fetch_pages(params) is called for each window in a background thread by
+    prefetch() while this thread upserts the pages, committing once per
+    window. At most `prefetch_pages` pages (PREFETCH_PAGES, default 4) are
+    fetched ahead, so the fetcher waits when the database falls behind. step
+    is the initial window size; later windows are sized by a WindowSizer from
+    the record count and fetch time of the previous window. upsert(cur, page)
+    stores one page in table. The watermark for endpoint advances in the same
+    transaction as each window, to the window end, or for the last window
+    before now to the newest record it loaded.
+
+    Without a stop time, complete shards of history are first loaded in
+    parallel with backfill() when BACKFILL_WORKERS is more than 1, and the
+    remaining windows up to now are loaded here."""
+
+    if stop is None:
+        start = backfill(endpoint, table, start, step, description, fetch_pages, upsert)
+
+    def fetch() -> typing.Iterator[list[dict] | _WindowEnd]:
+        sizer = WindowSizer(step)
+        for watermark, params in _windows(start, sizer, description, stop):
+            rows = 0
+            # time spent waiting on a full queue is not counted as fetch time
+            seconds = 0.0
+            started = time.monotonic()
+            for page in fetch_pages(params):
+                seconds += time.monotonic() - started
+                rows += len(page)
+                yield page
+                started = time.monotonic()
+            seconds += time.monotonic() - started
+            sizer.update(rows, seconds)
+            yield _WindowEnd(watermark)
+
+    items = prefetch(fetch(), prefetch_pages)
+    try:
+        done = False
+        while not done:
+            with cnx:
+                with cnx.cursor() as cur:
+                    for item in items:
+                        if isinstance(item, _WindowEnd):
+                            if item.watermark is not None:
+                                db.set_watermark(cur, endpoint, item.watermark)
+                            break
+                        upsert(cur, item)
+                        # only decides the watermark of the last window, as a
+                        # complete window moves it on to the window end
+                        db.set_watermark_from_stage(cur, endpoint, table)
+                    else:
+                        done = True
+    finally:
+        items.close()